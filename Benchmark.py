@@ -0,0 +1,387 @@
+"""
+Endpoint benchmarks against a seeded database.
+
+`seed` fills a throwaway database (SQLite by default) with a known number of
+sites, users and visits.  `run` drives every endpoint at each concurrency level,
+either in-process through the ASGI app or over HTTP against a running server,
+and reports throughput and p50/p95/p99 latency per endpoint.  Results are saved
+as JSON so `compare` can flag regressions between two runs.
+
+    python Benchmark.py seed --sites 10000 --users 1000 --visits 50
+    python Benchmark.py run --concurrency 1 8 32 --out before.json
+    python Benchmark.py run --url http://127.0.0.1:8000 --out http.json
+    python Benchmark.py compare before.json after.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+
+from SqlAlchemyTables import Metric
+
+
+DEFAULT_DB = "sqlite:///benchmark.db"
+ENDPOINTS = ["getSite", "getSites", "getHistory", "like", "submitSite", "getSubmissions", "addSite", "addSites",
+             "updateSubmissions", "getMetrics", "getMetricsBatch", "historyStumbles", "historyUsers",
+             "countUniqueUsers", "metrics", "serverMetrics", "ready"]
+
+
+def site_id(i):
+    return f"bench-site-{i}"
+
+
+def user_id(i):
+    return f"bench-user-{i}"
+
+
+def visited_site(args, user, j):
+    """
+    The j-th site seeded as visited by a user, so requests can refer to real visits.
+    """
+    return (user * args.visits + j) % args.sites
+
+
+def seed(args):
+    """
+    Recreate the schema in args.db and fill it, then roll up metrics, their
+    daily and weekly tiers and sketches for the seeded days so the history
+    endpoints have data to read.
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from SqlAlchemyTables import Base, Site, User, Visit, Submission
+    import MetricsRollup
+
+    engine = create_engine(args.db)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    rng = random.Random(args.seed)
+    now = datetime.datetime.now()
+    start = now - datetime.timedelta(days=args.days)
+    seconds = args.days * 24 * 60 * 60
+
+    def when():
+        return start + datetime.timedelta(seconds=rng.randrange(seconds))
+
+    def insert(table, rows):
+        with engine.begin() as conn:
+            for i in range(0, len(rows), args.batch):
+                conn.execute(table.__table__.insert(), rows[i:i + args.batch])
+
+    began = time.perf_counter()
+    insert(Site, [{"id": site_id(i), "url": f"https://example.com/{i}"} for i in range(args.sites)])
+    insert(User, [{"id": user_id(i), "createdDate": when()} for i in range(args.users)])
+    for first in range(0, args.users, max(1, args.batch // max(1, args.visits))):
+        last = min(args.users, first + max(1, args.batch // max(1, args.visits)))
+        insert(Visit, [{"siteId": site_id(visited_site(args, user, j)), "userId": user_id(user),
+                        "liked": rng.random() < 0.1, "createdDate": when()}
+                       for user in range(first, last) for j in range(min(args.visits, args.sites))])
+    insert(Submission, [{"url": f"https://submitted.example.com/{i}", "userId": user_id(i % args.users),
+                         "status": 0, "reason": "", "createdDate": when()} for i in range(args.submissions)])
+
+    session = sessionmaker(bind=engine)()
+    MetricsRollup.rollup(session, start, now)
+    for tier in ("daily", "weekly"):
+        MetricsRollup.catch_up_tier(session, tier, now)
+    session.close()
+    print(f"Seeded {args.sites} sites, {args.users} users, {args.users * min(args.visits, args.sites)} visits "
+          f"and {args.submissions} submissions in {time.perf_counter() - began:.1f}s")
+
+
+class Payloads:
+    """
+    Request bodies for each endpoint, drawn from the seeded data.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.counter = 0
+        now = datetime.datetime.now()
+        self.start = (now - datetime.timedelta(days=args.days)).replace(minute=0, second=0, microsecond=0)
+        self.end = now.replace(minute=0, second=0, microsecond=0)
+
+    def unique(self):
+        self.counter += 1
+        return f"{os.getpid()}-{time.time_ns()}-{self.counter}"
+
+    def user(self):
+        return self.rng.randrange(self.args.users)
+
+    def hours(self):
+        return int((self.end - self.start).total_seconds() // 3600)
+
+    def window(self):
+        """
+        A random range of whole hours within the seeded days, so analytics
+        requests measure the queries rather than the server's response cache.
+        """
+        first, last = sorted(self.rng.sample(range(self.hours() + 1), 2))
+        return (self.start + datetime.timedelta(hours=first),
+                self.start + datetime.timedelta(hours=last))
+
+    def get(self, endpoint):
+        args = self.args
+        if endpoint in ("getMetrics", "getMetricsBatch", "historyStumbles", "historyUsers"):
+            start, end = self.window()
+            history = {"start": start.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "end": end.strftime("%Y-%m-%dT%H:%M:%S"), "increment": 60}
+        if endpoint == "getSite":
+            user = self.user()
+            return {"userId": user_id(user),
+                    "prevId": site_id(visited_site(args, user, self.rng.randrange(max(1, args.visits))))}
+        if endpoint == "getSites":
+            user = self.user()
+            return {"userId": user_id(user), "count": 5,
+                    "prevIds": [site_id(visited_site(args, user, self.rng.randrange(max(1, args.visits))))
+                                for _ in range(5)]}
+        if endpoint == "getHistory":
+            return {"userId": user_id(self.user()), "pageSize": 10}
+        if endpoint == "like":
+            user = self.user()
+            return {"userId": user_id(user),
+                    "siteId": site_id(visited_site(args, user, self.rng.randrange(max(1, args.visits))))}
+        if endpoint == "submitSite":
+            return {"userId": user_id(self.user()), "url": f"https://new.example.com/{self.unique()}"}
+        if endpoint == "getSubmissions":
+            return {"status": 0, "pageSize": 100}
+        if endpoint == "addSite":
+            return {"auth": args.secret, "userId": user_id(self.user()),
+                    "url": f"https://added.example.com/{self.unique()}", "reason": ""}
+        if endpoint == "addSites":
+            return {"auth": args.secret, "userId": user_id(self.user()), "check": False,
+                    "urls": [f"https://added.example.com/{self.unique()}" for _ in range(20)], "reason": ""}
+        if endpoint == "updateSubmissions":
+            return {"auth": args.secret, "reason": "",
+                    "url": f"https://submitted.example.com/{self.rng.randrange(max(1, args.submissions))}",
+                    "newStatus": self.rng.choice([0, 2])}
+        if endpoint == "getMetrics":
+            return {"start": start.strftime("%Y-%m-%dT%H"),
+                    "end": end.strftime("%Y-%m-%dT%H"), "metricType": Metric.HOURLY_NEW_VISITS}
+        if endpoint == "getMetricsBatch":
+            return {"start": start.strftime("%Y-%m-%dT%H"), "end": end.strftime("%Y-%m-%dT%H"),
+                    "derived": ["uniqueUsers"]}
+        if endpoint == "historyStumbles":
+            return dict(history, liked=self.rng.random() < 0.5)
+        if endpoint == "historyUsers":
+            return history
+        if endpoint == "countUniqueUsers":
+            return {"nHoursBack": self.rng.randint(1, self.hours())}
+        return None
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of sorted values.
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+async def measure(client, payloads, endpoint, concurrency, total, warmup):
+    latencies = []
+    errors = 0
+
+    async def drive(count, timed):
+        remaining = count
+
+        async def worker():
+            nonlocal remaining, errors
+            while remaining > 0:
+                remaining -= 1
+                body = payloads.get(endpoint)
+                began = time.perf_counter()
+                try:
+                    if body is None:
+                        response = await client.get(f"/{endpoint}")
+                    else:
+                        response = await client.post(f"/{endpoint}", json=body)
+                    failed = response.status_code >= 400
+                except Exception:
+                    failed = True
+                if timed:
+                    latencies.append(time.perf_counter() - began)
+                    errors += failed
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    await drive(warmup, timed=False)
+    began = time.perf_counter()
+    await drive(total, timed=True)
+    seconds = time.perf_counter() - began
+
+    latencies.sort()
+    ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / seconds, 1) if seconds else None,
+        "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50": ms(percentile(latencies, 50)),
+        "p95": ms(percentile(latencies, 95)),
+        "p99": ms(percentile(latencies, 99)),
+    }
+
+
+async def wait_ready(client, timeout=300):
+    """
+    Wait for the server to finish warming up, servers without /ready count as ready.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if (await client.get("/ready")).status_code != 503:
+            return
+        await asyncio.sleep(0.5)
+    sys.exit("Server did not become ready")
+
+
+async def run_all(client, args):
+    await wait_ready(client)
+    payloads = Payloads(args)
+    results = []
+    for concurrency in args.concurrency:
+        for endpoint in args.endpoints:
+            result = await measure(client, payloads, endpoint, concurrency, args.requests, args.warmup)
+            results.append(result)
+            print(f"{endpoint:<18} c={concurrency:<4} {result['throughput'] or 0:>9.1f} req/s  "
+                  f"p50 {result['p50']}ms  p95 {result['p95']}ms  p99 {result['p99']}ms  "
+                  f"errors {result['errors']}")
+    return results
+
+
+async def run_in_process(args):
+    # main reads its configuration from the environment at import time.
+    os.environ["DB_STRING"] = args.db
+    os.environ["SECRET_KEY"] = args.secret
+    os.environ.setdefault("SITE_CATALOG", "benchmark-sitecatalog.bin")
+    import main
+
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            return await run_all(client, args)
+
+
+async def run_http(args):
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        return await run_all(client, args)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        sys.exit(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+
+    results = asyncio.run(run_http(args) if args.url else run_in_process(args))
+    report = {
+        "time": datetime.datetime.now().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "mode": "http" if args.url else "in-process",
+        "target": args.url or args.db,
+        "data": {"sites": args.sites, "users": args.users, "visits": args.visits,
+                 "submissions": args.submissions, "days": args.days},
+        "requests": args.requests,
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.out}")
+
+
+def compare(args):
+    """
+    Compare two result files, exiting with 1 if anything regressed past the threshold.
+    """
+    with open(args.baseline) as f:
+        baseline = {(r["endpoint"], r["concurrency"]): r for r in json.load(f)["results"]}
+    with open(args.candidate) as f:
+        candidate = json.load(f)["results"]
+
+    def change(before, after):
+        return (after - before) / before if before and after is not None else None
+
+    regressions = 0
+    print(f"{'endpoint':<18} {'c':>4} {'req/s':>17} {'p95 ms':>19} {'p99 ms':>19}")
+    for result in candidate:
+        before = baseline.get((result["endpoint"], result["concurrency"]))
+        if not before:
+            continue
+        throughput = change(before["throughput"], result["throughput"])
+        p95 = change(before["p95"], result["p95"])
+        p99 = change(before["p99"], result["p99"])
+        regressed = (throughput is not None and throughput < -args.threshold) or \
+            (p95 is not None and p95 > args.threshold) or (result["errors"] > before["errors"])
+        regressions += regressed
+        fmt = lambda value: "   n/a" if value is None else f"{value:+6.0%}"
+        print(f"{result['endpoint']:<18} {result['concurrency']:>4} "
+              f"{result['throughput'] or 0:>9.1f} {fmt(throughput)} "
+              f"{result['p95'] or 0:>10.2f} {fmt(p95)} {result['p99'] or 0:>10.2f} {fmt(p99)}"
+              f"{'  REGRESSED' if regressed else ''}")
+    print(f"{regressions} regressions beyond {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def data_options(command):
+        command.add_argument("--db", default=os.environ.get("BENCHMARK_DB", DEFAULT_DB),
+                             help="Database url, a throwaway SQLite file by default")
+        command.add_argument("--sites", type=int, default=10000)
+        command.add_argument("--users", type=int, default=1000)
+        command.add_argument("--visits", type=int, default=50, help="Visits per user")
+        command.add_argument("--submissions", type=int, default=500)
+        command.add_argument("--days", type=int, default=7, help="Days the visits are spread over")
+        command.add_argument("--seed", type=int, default=1)
+
+    command = commands.add_parser("seed", help="Recreate and fill the benchmark database")
+    data_options(command)
+    command.add_argument("--batch", type=int, default=10000, help="Rows per insert")
+    command.set_defaults(func=seed)
+
+    command = commands.add_parser("run", help="Benchmark the endpoints")
+    data_options(command)
+    command.add_argument("--url", help="Benchmark a running server instead of the app in-process")
+    command.add_argument("--secret", default=os.environ.get("SECRET_KEY", "benchmark"),
+                         help="SECRET_KEY for /addSite and /updateSubmissions")
+    command.add_argument("--endpoints", nargs="+", default=ENDPOINTS, metavar="ENDPOINT")
+    command.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    command.add_argument("--requests", type=int, default=200, help="Timed requests per endpoint and level")
+    command.add_argument("--warmup", type=int, default=20, help="Untimed requests before each measurement")
+    command.add_argument("--out", help="Write the results as JSON")
+    command.set_defaults(func=run)
+
+    command = commands.add_parser("compare", help="Compare two result files")
+    command.add_argument("baseline")
+    command.add_argument("candidate")
+    command.add_argument("--threshold", type=float, default=0.1,
+                         help="Relative change in throughput or p95 counted as a regression")
+    command.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,72 +1,249 @@
 """
-This script is intended to migrate from the old sqlite StumbleServer db to the 2020 model.
+Bulk import into the StumbleServer database (DB_STRING).
+
+    python DBMigration.py legacy OldStumble.db     # the old sqlite StumbleServer db
+    python DBMigration.py sites sites.csv          # site lists, CSV or NDJSON
+    python DBMigration.py sites sites.ndjson
+
+Sources are read with a cursor in batches and written with one bulk INSERT ...
+ON CONFLICT DO NOTHING per table and batch, checking visits against the site ids
+held in memory instead of querying for each one.  After every committed batch the
+position is saved to <source>.checkpoint, so an interrupted import picks up where
+it stopped when run again; the batch that was in flight is simply written twice.
+Site lists need a url column/key and may have an id, otherwise one is generated.
 """
 
-import sqlite3, json, os
-from sqlalchemy.orm import sessionmaker
-import sqlalchemy
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
+import argparse
+import csv
+import datetime
+import json
+import os
+import sqlite3
+import time
+from uuid import uuid4
+
+from sqlalchemy import select
+
 from SqlAlchemyTables import *
+from Database import engine, upsert
 
-db_string = os.environ["DB_STRING"]
-#engine = create_engine(db_string, echo=False)
-#engine = create_engine("sqlite:////home/hapax/projects/StumbleServer/test.db", echo=False)
 
-Session = sessionmaker(bind=engine)
-Base.metadata.create_all(engine)
+IMPORT_USER = "0"
 
-conn = sqlite3.connect("OldStumble.db")
-cur = conn.cursor()
-"""
-Copy over sites.
-"""
-cur.execute("select * from sites;")
-rows = cur.fetchall()
-unique_sites = {}
-for row in rows:
-    name = row[1].strip()
-    unique_sites[name] = row
-
-session = Session()
-u = User(id="0")
-session.add(u)
-for row in unique_sites:
-    siteId, url = unique_sites[row]
-    session.add(Site(id=siteId.strip(), url=url.strip()))
-    session.add(Submission(userId=u.id, url=url.strip(), status=1, reason="Imported in db migration."))
-session.commit()
-
-cur.execute("select * from users;")
-rows = cur.fetchall()
-
-#including_count = 0
-#excluding_count = 0
-count = 0
-good_count = 0
-
-session = Session()
-for i, row in enumerate(rows):
-    userId, j = row
-    j = j.replace("\n", "")
-    j = json.loads(j)
-
-    if type(j) == type({}):
-        user = User(id=userId)
-        session.add(user)
-        for k in j:
+
+class Checkpoint:
+    """
+    Import position saved as JSON next to the source, replaced atomically.
+    """
+
+    def __init__(self, source, restart=False):
+        self.path = source + ".checkpoint"
+        self.state = {}
+        if restart and os.path.exists(self.path):
+            os.remove(self.path)
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.state = json.load(f)
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def save(self, **state):
+        self.state.update(state)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class Progress:
+    def __init__(self, stage, done=0):
+        self.stage = stage
+        self.done = done
+        self.rows = 0
+        self.start = time.perf_counter()
+
+    def add(self, sources, rows):
+        self.done += sources
+        self.rows += rows
+        elapsed = time.perf_counter() - self.start
+        print(f"{self.stage}: {self.done} read, {self.rows} rows written, "
+              f"{self.rows / elapsed if elapsed else 0:.0f} rows/sec")
+
+
+def write(conn, table, rows):
+    if rows:
+        conn.execute(upsert(table).on_conflict_do_nothing(), rows)
+    return len(rows)
+
+
+def known_sites():
+    """
+    Ids and urls of the sites already in the database.
+    """
+    ids, urls = set(), set()
+    with engine.connect() as conn:
+        for site_id, url in conn.execution_options(yield_per=10000).execute(select(Site.id, Site.url)):
+            ids.add(site_id)
+            urls.add(url)
+    return ids, urls
+
+
+def ensure_import_user():
+    with engine.begin() as conn:
+        write(conn, User, [{"id": IMPORT_USER}])
+
+
+def write_sites(conn, sites, reason):
+    """
+    Insert new sites along with an accepted Submission for each.
+    """
+    # Dates are written from here, the database's CURRENT_TIMESTAMP would give a whole batch
+    # the same second, in sqlite in a different text form than dates the server writes.
+    now = datetime.datetime.now()
+    written = write(conn, Site, [{"id": site_id, "url": url, "createdDate": now} for site_id, url in sites])
+    written += write(conn, Submission, [{"url": url, "userId": IMPORT_USER, "status": 1, "reason": reason,
+                                         "createdDate": now} for _, url in sites])
+    return written
+
+
+def import_legacy_sites(source, checkpoint, site_ids, urls, batch_size):
+    cur = source.cursor()
+    last = checkpoint.get("sites", 0)
+    cur.execute("SELECT rowid, * FROM sites WHERE rowid > ? ORDER BY rowid", (last,))
+    progress = Progress("sites", last)
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        sites = []
+        for _, site_id, url in rows:
+            site_id, url = site_id.strip(), url.strip()
+            # The old db has repeated urls, keep the first site for each.
+            if url in urls or site_id in site_ids:
+                continue
+            urls.add(url)
+            site_ids.add(site_id)
+            sites.append((site_id, url))
+        with engine.begin() as conn:
+            written = write_sites(conn, sites, "Imported in db migration.")
+        checkpoint.save(sites=rows[-1][0])
+        progress.add(len(rows), written)
+
+
+def import_legacy_users(source, checkpoint, site_ids, batch_size):
+    cur = source.cursor()
+    last = checkpoint.get("users", 0)
+    errors = checkpoint.get("errors", 0)
+    cur.execute("SELECT rowid, * FROM users WHERE rowid > ? ORDER BY rowid", (last,))
+    progress = Progress("users", last)
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        users, visits = [], []
+        now = datetime.datetime.now()
+        for _, user_id, blob in rows:
             try:
-                s = session.query(Site).get(k)
-                if not s:
+                history = json.loads(blob.replace("\n", ""))
+            except ValueError:
+                errors += 1
+                continue
+            if not isinstance(history, dict):
+                continue
+            users.append({"id": user_id, "createdDate": now})
+            for site_id, visit in history.items():
+                if site_id not in site_ids:
                     continue
-                session.add(Visit(siteId=k, userId=user.id, liked=j[k].get("liked", False)))
-                good_count += 1
-            except:
-                count += 1
+                liked = visit.get("liked", False) if isinstance(visit, dict) else False
+                visits.append({"siteId": site_id, "userId": user_id, "liked": bool(liked), "createdDate": now})
+        with engine.begin() as conn:
+            written = write(conn, User, users) + write(conn, Visit, visits)
+        checkpoint.save(users=rows[-1][0], errors=errors)
+        progress.add(len(rows), written)
+    print(f"Users with unreadable history: {errors}")
+
+
+def legacy(args):
+    """
+    Copy sites, then users and their visits, from the old sqlite db.
+    """
+    checkpoint = Checkpoint(args.source, args.restart)
+    source = sqlite3.connect(args.source)
+    Base.metadata.create_all(engine)
+    ensure_import_user()
+    site_ids, urls = known_sites()
+    import_legacy_sites(source, checkpoint, site_ids, urls, args.batch)
+    import_legacy_users(source, checkpoint, site_ids, args.batch)
+    source.close()
+    # Servers never saw these visits, have them recompute what they cached.
+    with engine.begin() as conn:
+        DataVersion.bump(conn, DataVersion.VISITS)
+
+
+def read_site_list(path):
+    """
+    Yield (id or None, url) from a CSV file with a header row or an NDJSON file.
+    """
+    with open(path, newline="") as f:
+        if path.endswith((".ndjson", ".jsonl")):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        for row in rows:
+            yield (row.get("id") or None), row["url"].strip()
+
+
+def sites(args):
+    """
+    Import a site list, skipping urls and ids that are already known.
+    New sites are served once the health checker has seen them up.
+    """
+    checkpoint = Checkpoint(args.source, args.restart)
+    Base.metadata.create_all(engine)
+    ensure_import_user()
+    site_ids, urls = known_sites()
+    reason = args.reason or f"Imported from {os.path.basename(args.source)}."
+    last = checkpoint.get("line", 0)
+    progress = Progress("sites", last)
+
+    def flush(batch, line):
+        with engine.begin() as conn:
+            written = write_sites(conn, batch, reason)
+        checkpoint.save(line=line)
+        progress.add(line - progress.done, written)
+
+    batch, line = [], 0
+    for line, (site_id, url) in enumerate(read_site_list(args.source), 1):
+        if line <= last:
+            continue
+        if url and url not in urls and site_id not in site_ids:
+            site_id = site_id or str(uuid4())
+            urls.add(url)
+            site_ids.add(site_id)
+            batch.append((site_id, url))
+        if line % args.batch == 0:
+            flush(batch, line)
+            batch = []
+    if line > progress.done:
+        flush(batch, line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("legacy", help="Import the old sqlite StumbleServer db")
+    command.add_argument("source", nargs="?", default="OldStumble.db")
+    command.set_defaults(func=legacy)
+
+    command = commands.add_parser("sites", help="Import sites from CSV or NDJSON")
+    command.add_argument("source")
+    command.add_argument("--reason", help="Reason stored on the accepted submissions")
+    command.set_defaults(func=sites)
 
-    if i % 10 == 0:
-        print(f"{i}/{len(rows)}")
-        session.commit()
+    for command in commands.choices.values():
+        command.add_argument("--batch", type=int, default=5000, help="Source rows per bulk insert")
+        command.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start over")
 
-session.commit()
-print(f"Errors: {count} / {good_count + count}")
+    args = parser.parse_args()
+    args.func(args)
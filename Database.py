@@ -0,0 +1,62 @@
+"""
+Engines and sessions for the StumbleServer database.
+
+Request handlers talk to the database through the asyncio engine with one
+AsyncSession per request (see get_db).  The background workers in main.py run
+in their own threads and keep using the sync engine.
+"""
+
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+    "mysql": "mysql+aiomysql",
+}
+
+
+def async_url(db_string):
+    """
+    Turn a sync DB_STRING into the equivalent asyncio driver url.
+    """
+    url = make_url(db_string.replace("postgres://", "postgresql://", 1))
+    backend = url.drivername.split("+")[0]
+    if backend in ASYNC_DRIVERS:
+        url = url.set(drivername=ASYNC_DRIVERS[backend])
+    return url
+
+
+db_string = os.environ["DB_STRING"]
+engine = create_engine(db_string, echo=False, pool_size=15)
+Session = sessionmaker(bind=engine)
+
+async_engine = create_async_engine(async_url(db_string), echo=False, pool_size=15)
+AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+
+
+async def get_db():
+    """
+    FastAPI dependency giving each request its own AsyncSession.
+    """
+    async with AsyncSession() as session:
+        yield session
+
+
+def upsert(table):
+    """
+    Dialect specific INSERT for `table` that supports on_conflict_do_nothing/do_update.
+    """
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif engine.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise ValueError(f"Upserts are not supported for {engine.dialect.name}")
+    return insert(table)
@@ -0,0 +1,238 @@
+"""
+Concurrent site health checks.
+
+Sites are checked over a pooled httpx client with a bounded number of requests
+in flight (and a smaller bound per host), using HEAD and falling back to GET for
+servers that mishandle it.  Every check is stored in SiteCheck and the latest
+state in SiteHealth, which also schedules the next check: sites that stay up back
+off towards MAX_INTERVAL, sites that keep changing state are rechecked every
+MIN_INTERVAL.  Each pass claims the sites it checks, so every worker process
+can run the checker without doubling the traffic.
+
+Run this file directly to check a few urls against the local stub server,
+which stub_server() also starts for testing code that validates urls.
+"""
+
+import asyncio
+import datetime
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import httpx
+from sqlalchemy import or_, func, update, literal
+
+from SqlAlchemyTables import *
+
+
+class HealthChecker:
+    MIN_INTERVAL = 60 * 60
+    DEFAULT_INTERVAL = 24 * 60 * 60
+    MAX_INTERVAL = 7 * 24 * 60 * 60
+    FLAPPING = 1.5  # flaps halves every check and gains 1 per state change
+    HISTORY_DAYS = 90
+
+    def __init__(self, sm=None, concurrency=50, per_host=2, timeout=10.0, host_timeouts=None, on_change=None, transport=None):
+        self.sm = sm
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.host_timeouts = host_timeouts or {}
+        self.on_change = on_change
+        self.transport = transport
+
+    def client(self):
+        return httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.concurrency,
+                                max_keepalive_connections=self.concurrency),
+            headers={"User-Agent": "StumblingOn health check"},
+            transport=self.transport,
+        )
+
+    async def _status(self, client, url):
+        response = await client.head(url)
+        if response.status_code >= 400:
+            # Plenty of servers reject or mishandle HEAD, ask again with a GET before calling it down.
+            async with client.stream("GET", url) as response:
+                pass
+        return response.status_code
+
+    async def check_url(self, client, url):
+        """
+        Return (up, statusCode, latency in ms, error) for one url.
+        """
+        started = time.monotonic()
+        status, error = None, None
+        try:
+            status = await asyncio.wait_for(
+                self._status(client, url), self.host_timeouts.get(urlsplit(url).hostname, self.timeout))
+        except asyncio.TimeoutError:
+            error = "timeout"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:200]
+        latency = (time.monotonic() - started) * 1000
+        return status is not None and status < 400, status, latency, error
+
+    async def check_sites(self, sites):
+        """
+        Check (siteId, url) pairs concurrently and return {siteId: result}.
+        """
+        limit = asyncio.Semaphore(self.concurrency)
+        hosts = {}
+
+        async with self.client() as client:
+            async def check(site_id, url):
+                host = hosts.setdefault(
+                    urlsplit(url).hostname, asyncio.Semaphore(self.per_host))
+                # Wait for the host first, so checks queued behind a busy host don't hold global slots.
+                async with host, limit:
+                    return site_id, await self.check_url(client, url)
+
+            return dict(await asyncio.gather(*(check(site_id, url) for site_id, url in sites)))
+
+    def next_interval(self, health, changed):
+        if health.flaps >= self.FLAPPING:
+            return self.MIN_INTERVAL
+        if not health.up:
+            # Down sites are retried after 1h, 2h, 4h ... up to once a day.
+            return min(self.MIN_INTERVAL * 2 ** min(health.failures - 1, 8), self.DEFAULT_INTERVAL)
+        if changed or not health.interval:
+            return self.DEFAULT_INTERVAL
+        return min(health.interval * 2, self.MAX_INTERVAL)
+
+    def record(self, session, site_id, health, result, now):
+        """
+        Store one check result and return the site's SiteHealth row.
+        """
+        up, status, latency, error = result
+        if health is None:
+            health = SiteHealth(siteId=site_id, up=up, failures=0, flaps=0)
+            session.add(health)
+        changed = health.lastChecked is not None and health.up != up
+
+        health.up = up
+        health.statusCode = status
+        health.flaps = health.flaps / 2 + (1 if changed else 0)
+        health.failures = 0 if up else health.failures + 1
+        health.interval = self.next_interval(health, changed)
+        health.lastChecked = now
+        health.nextCheck = now + datetime.timedelta(seconds=health.interval)
+
+        session.add(SiteCheck(siteId=site_id, time=now, up=up,
+                    statusCode=status, latency=latency, error=error))
+        return health
+
+    def claim(self, session, now):
+        """
+        Claim the sites that are due by moving their nextCheck past this pass,
+        so other workers running the checker skip them.  Returns [(siteId, url, SiteHealth)].
+        """
+        from Database import upsert
+
+        # Sites that were never checked get a row to claim.
+        unchecked = session.query(Site.id, literal(True), literal(0), literal(0)).outerjoin(
+            SiteHealth, SiteHealth.siteId == Site.id).filter(SiteHealth.siteId == None)
+        session.execute(upsert(SiteHealth).from_select(
+            ["siteId", "up", "failures", "flaps"], unchecked).on_conflict_do_nothing())
+        # A row another worker claims first is re-evaluated after its commit and no longer matches.
+        claimed_until = now + datetime.timedelta(seconds=self.MIN_INTERVAL)
+        claimed = set(session.scalars(update(SiteHealth).where(
+            or_(SiteHealth.nextCheck == None, SiteHealth.nextCheck <= now)).values(
+            nextCheck=claimed_until).returning(SiteHealth.siteId)))
+        session.commit()
+        if not claimed:
+            return []
+        rows = session.query(Site.id, Site.url, SiteHealth).join(
+            SiteHealth, SiteHealth.siteId == Site.id).filter(SiteHealth.nextCheck == claimed_until)
+        return [row for row in rows if row[0] in claimed]
+
+    def run_once(self):
+        """
+        Check every site that is due, store the results and report them to
+        on_change as one list of (siteId, url, up) so the catalog is republished
+        at most once per pass.  Sites are claimed first, so every worker can run
+        this without checking a site twice; a pass that dies leaves its sites
+        to be checked again after MIN_INTERVAL.
+        """
+        session = self.sm()
+        now = datetime.datetime.now()
+        due = self.claim(session, now)
+
+        results = asyncio.run(self.check_sites(
+            (site_id, url) for site_id, url, _ in due)) if due else {}
+
+        for site_id, url, health in due:
+            self.record(session, site_id, health, results[site_id], now)
+        session.query(SiteCheck).filter(
+            SiteCheck.time < now - datetime.timedelta(days=self.HISTORY_DAYS)).delete()
+        session.commit()
+
+        if self.on_change and due:
+            self.on_change([(site_id, url, results[site_id][0]) for site_id, url, _ in due])
+
+        up = sum(1 for result in results.values() if result[0])
+        print(f"{datetime.datetime.utcnow()}: checked {len(due)} sites, {up} up")
+
+        next_check = session.query(func.min(SiteHealth.nextCheck)).scalar()
+        session.close()
+        return next_check
+
+    def run_forever(self, initial_delay=100, heartbeat=None):
+        time.sleep(initial_delay)
+        while True:
+            try:
+                next_check = self.run_once()
+            except Exception as e:
+                print(f"{datetime.datetime.utcnow()}: health check failed: {e}")
+                next_check = None
+            if heartbeat:
+                heartbeat()
+            wait = (next_check - datetime.datetime.now()
+                    ).total_seconds() if next_check else self.MIN_INTERVAL
+            time.sleep(min(max(wait, 60), self.MIN_INTERVAL))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers 200 except /down (503), /nohead (405 to HEAD) and /slow (after 3s).
+    """
+
+    def respond(self, head):
+        if self.path == "/slow":
+            time.sleep(3)
+        status = {"/down": 503, "/nohead": 405 if head else 200}.get(self.path, 200)
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.respond(True)
+
+    def do_GET(self):
+        self.respond(False)
+
+    def log_message(self, *args):
+        pass
+
+
+def stub_server():
+    """
+    Start a StubHandler server on a free local port, returns (server, base url).
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+if __name__ == "__main__":
+    server, base = stub_server()
+    checker = HealthChecker(timeout=1)
+    paths = ["/ok", "/nohead", "/down", "/slow"]
+    results = asyncio.run(checker.check_sites(
+        (path, base + path) for path in paths))
+    for path in paths:
+        print(path, results[path])
+    server.shutdown()
@@ -0,0 +1,146 @@
+"""
+HyperLogLog sketches for approximate unique user counts.
+
+Each hour of visits gets a sketch of the user ids seen in it (about 1.6% error
+with the default 4096 registers).  Sketches are merged by taking the larger
+register, so the unique users over any window is a merge of its hourly sketches
+instead of a COUNT(DISTINCT) over Visit, and merging the same data twice is harmless.
+"""
+
+import datetime
+import hashlib
+import math
+import threading
+
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+
+from SqlAlchemyTables import *
+
+
+class HyperLogLog:
+    def __init__(self, p=12, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers else bytearray(self.m)
+
+    def add(self, value):
+        x = int.from_bytes(hashlib.blake2b(
+            value.encode(), digest_size=8).digest(), "big")
+        index = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = 64 - self.p - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, *others):
+        if not others:
+            return self
+        self.registers = bytearray(
+            map(max, self.registers, *(other.registers for other in others)))
+        return self
+
+    def count(self):
+        m = self.m
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / \
+            sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate while most registers are empty.
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def copy(self):
+        return HyperLogLog(self.p, self.registers)
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(len(data).bit_length() - 1, data)
+
+
+def floor_hour(d):
+    return datetime.datetime(d.year, d.month, d.day, d.hour)
+
+
+SAVE_BATCH = 500  # Hours per query
+
+
+def save(session, sketches, description=MetricSketch.HOURLY_USERS):
+    """
+    Merge {hour: HyperLogLog} into the stored sketches and commit.  Stored
+    sketches are read with one query per SAVE_BATCH hours and written back with
+    one bulk update, new hours with one bulk insert.
+    """
+    hours = sorted(sketches)
+    for i in range(0, len(hours), SAVE_BATCH):
+        batch = hours[i:i + SAVE_BATCH]
+        stored = dict(session.query(MetricSketch.time, MetricSketch.registers).filter(
+            MetricSketch.description == description, MetricSketch.time.in_(batch)).with_for_update())
+        merged = [{"time": hour, "description": description,
+                   "registers": sketches[hour].copy().merge(HyperLogLog.from_bytes(stored[hour])).to_bytes()}
+                  for hour in batch if hour in stored]
+        new = [{"time": hour, "description": description, "registers": sketches[hour].to_bytes()}
+               for hour in batch if hour not in stored]
+        if merged:
+            session.execute(update(MetricSketch), merged)
+        if new:
+            session.execute(insert(MetricSketch), new)
+    session.commit()
+
+
+class HourlySketches:
+    """
+    Sketches of the users visiting in each recent hour, updated as visits are
+    recorded and saved to MetricSketch by a background thread.  Only the last
+    `keep_hours` are held in memory.
+    """
+
+    def __init__(self, keep_hours=48):
+        self.lock = threading.Lock()
+        self.keep_hours = keep_hours
+        self.hours = {}  # hour -> HyperLogLog
+        self.dirty = set()
+
+    def add(self, user_id, when=None):
+        hour = floor_hour(when or datetime.datetime.now())
+        with self.lock:
+            sketch = self.hours.get(hour)
+            if sketch is None:
+                sketch = self.hours[hour] = HyperLogLog()
+            sketch.add(user_id)
+            self.dirty.add(hour)
+
+    def recent(self, start, end):
+        """
+        In-memory sketches for hours in [start, end), which may not be saved yet.
+        """
+        with self.lock:
+            return [sketch.copy() for hour, sketch in self.hours.items() if start <= hour < end]
+
+    def persist(self, session):
+        with self.lock:
+            dirty = {hour: self.hours[hour].copy() for hour in self.dirty}
+            self.dirty = set()
+            cutoff = floor_hour(datetime.datetime.now()) - \
+                datetime.timedelta(hours=self.keep_hours)
+            for hour in [hour for hour in self.hours if hour < cutoff and hour not in dirty]:
+                del self.hours[hour]
+        try:
+            save(session, dirty)
+        except IntegrityError:
+            # Another worker created the same hour first, merge into its row next time.
+            session.rollback()
+            with self.lock:
+                self.dirty |= dirty.keys()
+
+
+def estimate(rows, recent=()):
+    """
+    Unique users across stored sketch registers and in-memory sketches.
+    """
+    sketch = HyperLogLog()
+    sketch.merge(*(HyperLogLog.from_bytes(registers) for registers in rows), *recent)
+    return sketch.count()
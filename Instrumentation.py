@@ -0,0 +1,199 @@
+"""
+Request, database and worker instrumentation in the Prometheus text format.
+
+RequestMetrics is plain ASGI middleware that times each request and counts the
+statements it runs.  Statements are counted by SQLAlchemy engine events into
+per-request stats held in a context variable, which follows the request into
+the greenlets the asyncio engine runs its driver calls in.  Everything is kept
+in process, so with several workers each one reports its own numbers.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# [statements, statement seconds, endpoint, perf_counter at start] for the current request
+request_stats = ContextVar("request_stats", default=None)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, *labels, value):
+        with self.lock:
+            self.values[labels] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.series = {}  # labels -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, *labels, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            series[i] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        with self.lock:
+            for labels, series in sorted(self.series.items()):
+                total = 0
+                for bound, count in zip(self.buckets + ("+Inf",), series):
+                    total += count
+                    lines.append(f"{self.name}_bucket{format_labels(names, labels + (bound,))} {total}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {series[-1]}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {total}")
+        return lines
+
+
+requests = Counter("stumble_requests_total", "Requests handled", ("endpoint", "status"))
+latency = Histogram("stumble_request_seconds", "Request latency", LATENCY_BUCKETS, ("endpoint",))
+request_queries = Histogram("stumble_request_db_queries", "Statements run per request",
+                            QUERY_BUCKETS, ("endpoint",))
+request_db_time = Histogram("stumble_request_db_seconds", "Database time per request",
+                            LATENCY_BUCKETS, ("endpoint",))
+queries = Counter("stumble_db_queries_total", "Statements run, in and outside requests", ("engine",))
+db_time = Counter("stumble_db_seconds_total", "Time spent in statements", ("engine",))
+cache_lookups = Counter("stumble_response_cache_total", "Analytics response cache lookups",
+                        ("endpoint", "outcome"))
+log_records = Counter("stumble_log_records_total", "Log records written, sampled out or dropped", ("outcome",))
+write_behind = Counter("stumble_write_behind_total", "Visit writes buffered, or written through while the buffer is full",
+                       ("outcome",))
+heartbeats = Gauge("stumble_worker_heartbeat_timestamp_seconds",
+                   "Unix time each background worker last completed a pass", ("worker",))
+
+METRICS = [requests, latency, request_queries, request_db_time, queries, db_time, cache_lookups, log_records,
+           write_behind, heartbeats]
+engines = {}  # name -> engine whose pool is reported
+
+
+def heartbeat(worker):
+    heartbeats.set(worker, value=time.time())
+
+
+def instrument_engine(engine, name):
+    """
+    Count statements and their time on a sync engine (for an asyncio engine pass
+    its sync_engine) and report its connection pool.
+    """
+    engines[name] = engine
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._query_start
+        queries.inc(name)
+        db_time.inc(name, amount=elapsed)
+        stats = request_stats.get()
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += elapsed
+
+
+def render_pools():
+    lines = []
+    for metric, help in (("checked_out", "Connections currently checked out"),
+                         ("overflow", "Connections open beyond pool_size"),
+                         ("size", "Configured pool size")):
+        lines.append(f"# HELP stumble_db_pool_{metric} {help}")
+        lines.append(f"# TYPE stumble_db_pool_{metric} gauge")
+        for name, engine in sorted(engines.items()):
+            method = getattr(engine.pool, metric.replace("_", ""), None)
+            if method:
+                # overflow() counts up from -pool_size until the pool is full.
+                lines.append(f'stumble_db_pool_{metric}{{engine="{name}"}} {max(0, method())}')
+    return lines
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(render_pools())
+    return "\n".join(lines) + "\n"
+
+
+class RequestMetrics:
+    """
+    ASGI middleware recording per endpoint counts, latency and database use.
+    Requests to paths that aren't routes are grouped as "other" to keep the
+    number of series bounded.
+    """
+
+    def __init__(self, app, routes=()):
+        self.app = app
+        self.paths = {route.path for route in routes}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        endpoint = scope["path"] if scope["path"] in self.paths else "other"
+        status = [500]
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        began = time.perf_counter()
+        stats = [0, 0.0, endpoint, began]
+        token = request_stats.set(stats)
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - began
+            request_stats.reset(token)
+            requests.inc(endpoint, status[0])
+            latency.observe(endpoint, value=elapsed)
+            request_queries.observe(endpoint, value=stats[0])
+            request_db_time.observe(endpoint, value=stats[1])
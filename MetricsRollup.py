@@ -0,0 +1,255 @@
+"""
+Hourly metric rollups, and daily and weekly tiers derived from them.
+
+Visits, likes and new users for a whole range of hours are counted with one
+grouped query per table and written to Metric in bulk, so catching up after
+downtime costs the same few queries whether one hour or a month is missing.
+The daily and weekly tiers sum the hourly rows of each whole day or week
+(weeks start on Monday) into Metric rows named "Daily ..." and "Weekly ...",
+so long ranges can be served from a few hundred rows.  Whichever process rolls
+up new hours also refreshes SiteStats, the per site counts SiteWeights reads.
+
+    python MetricsRollup.py                     # catch up to the last full hour
+    python MetricsRollup.py 2021-01-01T00 2021-02-01T00 --recompute
+"""
+
+import datetime
+
+from sqlalchemy import func, case
+
+from SqlAlchemyTables import *
+from TimeBuckets import bucket_index, bucket_range, zero_fill
+from HyperLogLog import floor_hour
+import HyperLogLog
+import VisitArchive
+
+
+HOURLY = (Metric.HOURLY_NEW_VISITS, Metric.HOURLY_LIKES, Metric.HOURLY_NEW_USERS)
+TIERS = {"hourly": 60, "daily": 24 * 60, "weekly": 7 * 24 * 60}  # Minutes per point
+
+
+def floor_period(d, tier):
+    if tier == "hourly":
+        return floor_hour(d)
+    day = datetime.datetime(d.year, d.month, d.day)
+    return day if tier == "daily" else day - datetime.timedelta(days=day.weekday())
+
+
+def tier_description(description, tier):
+    """
+    Name of an hourly metric's rows in a tier, "Hourly Visits" -> "Daily Visits".
+    """
+    return description if tier == "hourly" else description.replace("Hourly", tier.capitalize(), 1)
+
+
+def count_hours(session, start, end):
+    """
+    Return [(hour, visits, likes, new users)] for every hour in [start, end).
+    """
+    dialect = session.get_bind().dialect.name
+
+    visit = VisitArchive.visits_since(start)
+    hour = bucket_index(visit.c.createdDate, start, 60, dialect)
+    visits = session.query(hour, func.count(), func.sum(case((visit.c.liked == True, 1), else_=0))).filter(
+        *bucket_range(visit.c.createdDate, start, end, 60)).group_by(hour)
+
+    hour = bucket_index(User.createdDate, start, 60, dialect)
+    users = dict(session.query(hour, func.count()).filter(
+        *bucket_range(User.createdDate, start, end, 60)).group_by(hour).all())
+
+    return [(time, n_visits, n_likes, users.get(i, 0)) for i, (time, n_visits, n_likes)
+            in enumerate(zero_fill(visits, start, end, 60, columns=2))]
+
+
+def sketch_hours(session, start, end):
+    """
+    Rebuild the hourly unique user sketches for [start, end) from Visit and
+    merge them into MetricSketch.
+    """
+    visits = VisitArchive.visits_since(start)
+    hour = bucket_index(visits.c.createdDate, start, 60, session.get_bind().dialect.name)
+    sketches = {}
+    for i, user_id in session.query(hour, visits.c.userId).filter(
+            *bucket_range(visits.c.createdDate, start, end, 60)).distinct().yield_per(10000):
+        time = start + datetime.timedelta(hours=int(i))
+        sketches.setdefault(time, HyperLogLog.HyperLogLog()).add(user_id)
+    HyperLogLog.save(session, sketches)
+
+
+def backfill_sketches(session, now=None, days=7):
+    """
+    Build the hourly unique user sketches for every visit up to the current hour,
+    a few days per pass to keep memory bounded.  For data recorded before the
+    sketches existed or imported without them.
+    """
+    first = session.query(func.min(VisitArchive.all_visits().c.createdDate)).scalar()
+    if not first:
+        return
+    end = floor_hour(now or datetime.datetime.now()) + datetime.timedelta(hours=1)
+    start = floor_hour(first)
+    while start < end:
+        sketch_hours(session, start, min(start + datetime.timedelta(days=days), end))
+        start += datetime.timedelta(days=days)
+    DataVersion.bump(session, DataVersion.METRICS)
+    session.commit()
+
+
+def refresh_site_stats(session, batch_size=5000):
+    """
+    Write every site's visit and like counts to SiteStats.  Returns the number of sites.
+    """
+    # Not at the top, the server and Benchmark.py seed import this module before or without DB_STRING.
+    from Database import upsert
+
+    visit = VisitArchive.all_visits()
+    counts = session.query(visit.c.siteId, func.count(), func.sum(case((visit.c.liked == True, 1), else_=0))).group_by(
+        visit.c.siteId)
+    rows = [{"siteId": site_id, "visits": visits, "likes": int(likes or 0)} for site_id, visits, likes in counts]
+    statement = upsert(SiteStats)
+    statement = statement.on_conflict_do_update(
+        index_elements=[SiteStats.siteId], set_={"visits": statement.excluded.visits, "likes": statement.excluded.likes})
+    for i in range(0, len(rows), batch_size):
+        session.execute(statement, rows[i:i + batch_size])
+    session.commit()
+    return len(rows)
+
+
+def rollup(session, start, end, recompute=False):
+    """
+    Write the hourly metrics for [start, end).  Hours that already have metrics
+    are left alone unless recompute is set, in which case they are replaced.
+    The unique user sketches for the range are rebuilt as well.
+    Returns the number of hours written.
+    """
+    start, end = floor_hour(start), floor_hour(end)
+    in_range = session.query(Metric).filter(
+        Metric.description.in_(HOURLY), Metric.time >= start, Metric.time < end)
+
+    if recompute:
+        in_range.delete(synchronize_session=False)
+        DataVersion.bump(session, DataVersion.METRICS)
+        done = set()
+    else:
+        done = set(time for (time,) in in_range.with_entities(Metric.time).distinct())
+
+    rows = []
+    for time, visits, likes, users in count_hours(session, start, end):
+        if time in done:
+            continue
+        rows.append({"time": time, "description": Metric.HOURLY_NEW_VISITS, "amount": visits})
+        rows.append({"time": time, "description": Metric.HOURLY_LIKES, "amount": likes})
+        rows.append({"time": time, "description": Metric.HOURLY_NEW_USERS, "amount": users})
+
+    session.bulk_insert_mappings(Metric, rows)
+    session.commit()
+    sketch_hours(session, start, end)
+    return len(rows) // len(HOURLY)
+
+
+def rollup_tier(session, tier, start, end, recompute=False):
+    """
+    Sum the hourly metrics of every whole day or week in [start, end) into
+    `tier`.  Existing tier rows are left alone unless recompute is set.
+    Returns the number of rows written.
+    """
+    minutes = TIERS[tier]
+    start, end = floor_period(start, tier), floor_period(end, tier)
+    if start >= end:
+        return 0
+    names = {description: tier_description(description, tier) for description in HOURLY}
+    in_range = session.query(Metric).filter(
+        Metric.description.in_(names.values()), Metric.time >= start, Metric.time < end)
+
+    if recompute:
+        in_range.delete(synchronize_session=False)
+        DataVersion.bump(session, DataVersion.METRICS)
+        done = set()
+    else:
+        done = set(in_range.with_entities(Metric.description, Metric.time))
+
+    period = bucket_index(Metric.time, start, minutes, session.get_bind().dialect.name)
+    sums = session.query(Metric.description, period, func.sum(Metric.amount)).filter(
+        Metric.description.in_(HOURLY), *bucket_range(Metric.time, start, end, minutes)).group_by(
+        Metric.description, period)
+
+    rows = []
+    for description, i, amount in sums:
+        time = start + datetime.timedelta(minutes=minutes * int(i))
+        if (names[description], time) not in done:
+            rows.append({"time": time, "description": names[description], "amount": int(amount or 0)})
+
+    session.bulk_insert_mappings(Metric, rows)
+    session.commit()
+    return len(rows)
+
+
+def catch_up_tier(session, tier, now=None):
+    """
+    Roll up every whole period since the last one in `tier`, starting from the
+    first hourly metric when the tier is empty.
+    """
+    end = floor_period(now or datetime.datetime.now(), tier)
+    last = session.query(func.max(Metric.time)).filter(
+        Metric.description.in_([tier_description(description, tier) for description in HOURLY])).scalar()
+    if last:
+        start = last + datetime.timedelta(minutes=TIERS[tier])
+    else:
+        start = session.query(func.min(Metric.time)).filter(Metric.description.in_(HOURLY)).scalar()
+        if not start:
+            return 0
+    return rollup_tier(session, tier, start, end)
+
+
+def catch_up(session, now=None):
+    """
+    Roll up every full hour between the last hourly metric and now, then the
+    days and weeks those hours completed.
+    """
+    now = now or datetime.datetime.now()
+    end = floor_hour(now)
+    last = session.query(func.max(Metric.time)).filter(
+        Metric.description.in_(HOURLY)).scalar()
+    if last:
+        start = floor_hour(last) + datetime.timedelta(hours=1)
+    else:
+        first = session.query(func.min(VisitArchive.all_visits().c.createdDate)).scalar()
+        if not first:
+            return 0
+        start = floor_hour(first)
+
+    if start >= end:
+        return 0
+    hours = rollup(session, start, end)
+    print(f"{datetime.datetime.utcnow()}: added metrics for {hours} hours from {start} to {end}")
+    for tier in ("daily", "weekly"):
+        catch_up_tier(session, tier, now)
+    if hours:
+        refresh_site_stats(session)
+    return hours
+
+
+if __name__ == "__main__":
+    import argparse
+    from Database import Session
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("start", nargs="?", help="YYYY-MM-DDTHH, omit to catch up")
+    parser.add_argument("end", nargs="?", help="YYYY-MM-DDTHH, defaults to now")
+    parser.add_argument("--recompute", action="store_true",
+                        help="Replace metrics that already exist in the range")
+    args = parser.parse_args()
+
+    session = Session()
+    if args.start:
+        start = datetime.datetime.strptime(args.start, "%Y-%m-%dT%H")
+        end = datetime.datetime.strptime(args.end, "%Y-%m-%dT%H") if args.end else datetime.datetime.now()
+        print(f"Wrote metrics for {rollup(session, start, end, args.recompute)} hours")
+        for tier in ("daily", "weekly"):
+            # Every whole period the hours fall in, as far as it has already ended.
+            last = floor_period(end - datetime.timedelta(microseconds=1), tier) + \
+                datetime.timedelta(minutes=TIERS[tier])
+            written = rollup_tier(session, tier, start, min(last, datetime.datetime.now()), args.recompute)
+            print(f"Wrote {written} {tier} metrics")
+    else:
+        catch_up(session)
+    session.close()
@@ -0,0 +1,223 @@
+"""
+Versioned schema migrations for an existing StumbleServer database.
+
+Each migration is applied once and recorded in SchemaVersion.  Indexes are built
+with CREATE INDEX CONCURRENTLY on postgres, so migrating a live database does not
+block writes.
+
+    python Migrations.py status     # show applied and pending migrations
+    python Migrations.py migrate    # apply pending migrations
+    python Migrations.py explain    # print query plans for the endpoint queries
+"""
+
+import datetime
+import sys
+
+from sqlalchemy import select, func, distinct, text, Table, MetaData
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex
+
+from SqlAlchemyTables import *
+from TimeBuckets import bucket_index, bucket_range
+import MetricsRollup
+import VisitArchive
+
+
+# Indexes built by applied migrations that later ones replaced: name -> columns.
+RETIRED_INDEXES = {
+    "ix_visit_user_created": ("userId", "createdDate"),
+    "ix_submission_status": ("status",),
+}
+
+
+def table_index(table, name):
+    for index in table.indexes:
+        if index.name == name:
+            return index
+    # Declared on a copy of the table, so create_all doesn't build it anymore.
+    columns = RETIRED_INDEXES[name]
+    copy = Table(table.name, MetaData(), *(Column(column, table.c[column].type) for column in columns))
+    return Index(name, *(copy.c[column] for column in columns))
+
+
+def create_index(conn, table, name):
+    """
+    Build one of the indexes declared on a model if it doesn't exist yet.
+    """
+    index = table_index(table, name)
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=conn.dialect))
+    if conn.dialect.name == "postgresql":
+        # An interrupted concurrent build leaves an invalid index behind, drop it and start over.
+        invalid = conn.execute(text(
+            "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"), {"name": name}).first()
+        if invalid:
+            conn.exec_driver_sql(f'DROP INDEX CONCURRENTLY "{name}"')
+        ddl = ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+    print(f"  {ddl}")
+    conn.exec_driver_sql(ddl)
+
+
+def drop_index(conn, name):
+    ddl = f'DROP INDEX IF EXISTS "{name}"'
+    if conn.dialect.name == "postgresql":
+        ddl = ddl.replace("DROP INDEX", "DROP INDEX CONCURRENTLY", 1)
+    print(f"  {ddl}")
+    conn.exec_driver_sql(ddl)
+
+
+def create_tables(conn, *tables):
+    Base.metadata.create_all(conn, tables=[table.__table__ for table in tables])
+
+
+def add_hot_query_indexes(conn):
+    create_index(conn, Visit.__table__, "ix_visit_user_created")
+    create_index(conn, Visit.__table__, "ix_visit_created_liked")
+    create_index(conn, Submission.__table__, "ix_submission_status")
+    create_index(conn, Metric.__table__, "ix_metric_description_time")
+    create_index(conn, User.__table__, "ix_user_created")
+    create_tables(conn, SiteHealth, SiteCheck)
+    create_index(conn, SiteHealth.__table__, "ix_sitehealth_next_check")
+    create_index(conn, SiteCheck.__table__, "ix_sitecheck_site_time")
+
+
+def add_metric_sketches(conn):
+    create_tables(conn, MetricSketch)
+
+
+def add_submission_queue_index(conn):
+    create_index(conn, Submission.__table__, "ix_submission_status_created")
+
+
+def add_visit_archive(conn):
+    create_tables(conn, ArchivedVisit)
+
+
+def backfill_sketches(conn):
+    # Estimates are served from the sketches, which only existed for hours after migration 2.
+    create_tables(conn, MetricSketch, DataVersion)
+    session = Session(bind=conn)
+    MetricsRollup.backfill_sketches(session)
+    session.close()
+
+
+def add_data_versions(conn):
+    create_tables(conn, DataVersion)
+
+
+def add_reservations(conn):
+    create_tables(conn, Reservation)
+
+
+def add_site_to_history_indexes(conn):
+    create_index(conn, Visit.__table__, "ix_visit_user_created_site")
+    create_index(conn, ArchivedVisit.__table__, "ix_archivedvisit_user_created_site")
+    # Prefixes of the new ones.
+    drop_index(conn, "ix_visit_user_created")
+    drop_index(conn, "ix_archivedvisit_user_created")
+
+
+def add_site_stats(conn):
+    # Weighted stumbles read these instead of counting every visit in each worker.
+    create_tables(conn, SiteStats)
+    session = Session(bind=conn)
+    MetricsRollup.refresh_site_stats(session)
+    session.close()
+
+
+def drop_submission_status_index(conn):
+    # A prefix of ix_submission_status_created from migration 3, so it only costs writes.
+    drop_index(conn, "ix_submission_status")
+
+
+MIGRATIONS = [
+    (1, "Indexes for the hot query shapes", add_hot_query_indexes),
+    (2, "Hourly unique user sketches", add_metric_sketches),
+    (3, "Submission queue pagination index", add_submission_queue_index),
+    (4, "Archive table for old visits", add_visit_archive),
+    (5, "Unique user sketches for existing visits", backfill_sketches),
+    (6, "Versions of the data behind cached analytics", add_data_versions),
+    (7, "Site reservations shared by every worker", add_reservations),
+    (8, "History indexes in page order", add_site_to_history_indexes),
+    (9, "Per site counts for weighted stumbles", add_site_stats),
+    (10, "Drop the status only submission index", drop_submission_status_index),
+]
+
+
+def applied(engine):
+    create_tables(engine, SchemaVersion)
+    with engine.connect() as conn:
+        return set(conn.execute(select(SchemaVersion.version)).scalars())
+
+
+def migrate(engine):
+    done = applied(engine)
+    # Autocommit so each statement stands alone, CONCURRENTLY can't run inside a transaction.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for version, description, apply in MIGRATIONS:
+            if version in done:
+                continue
+            print(f"Applying {version}: {description}")
+            apply(conn)
+            conn.execute(SchemaVersion.__table__.insert().values(
+                version=version, description=description))
+    print("Up to date")
+
+
+def status(engine):
+    done = applied(engine)
+    for version, description, _ in MIGRATIONS:
+        print(f"{version:>4} {'applied' if version in done else 'pending':<8} {description}")
+
+
+def endpoint_queries(conn):
+    """
+    The statements behind the hot endpoints, with realistic parameters.
+    """
+    user_id = conn.execute(select(Visit.userId).order_by(Visit.createdDate.desc()).limit(1)).scalar() or "0"
+    end = datetime.datetime.now()
+    start = end - datetime.timedelta(days=7)
+    bucket = bucket_index(Visit.createdDate, start, 60, conn.dialect.name)
+    # A user's visits are read from Visit and ArchivedVisit together.
+    visits = VisitArchive.user_visits(user_id)
+
+    return [
+        ("/getSite visited sites", select(visits.c.siteId)),
+        ("/getHistory page", select(visits.c.siteId, Site.url, visits.c.liked, visits.c.createdDate).outerjoin(
+            Site, Site.id == visits.c.siteId).order_by(visits.c.createdDate.desc(), visits.c.siteId.desc()).limit(11)),
+        ("/historyStumbles liked", select(bucket, func.count()).where(
+            *bucket_range(Visit.createdDate, start, end, 60), Visit.liked == True).group_by(bucket)),
+        ("/historyUsers", select(bucket, func.count(distinct(Visit.userId))).where(
+            *bucket_range(Visit.createdDate, start, end, 60)).group_by(bucket)),
+        ("/countUniqueUsers", select(func.count(distinct(Visit.userId))).where(
+            Visit.createdDate >= start)),
+        ("/getSubmissions", select(Submission).where(Submission.status == 0).order_by(
+            Submission.createdDate, Submission.url).limit(101)),
+        ("/getMetrics", select(Metric.time, Metric.amount).where(
+            Metric.description == Metric.HOURLY_NEW_VISITS, Metric.time >= start, Metric.time <= end)),
+        ("metrics rollup new users", select(func.count()).select_from(User).where(
+            User.createdDate >= start, User.createdDate < end)),
+    ]
+
+
+def explain(engine):
+    prefix = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+    with engine.connect() as conn:
+        for name, statement in endpoint_queries(conn):
+            compiled = statement.compile(dialect=conn.dialect)
+            params = compiled.params
+            if compiled.positional:
+                params = tuple(params[key] for key in compiled.positiontup)
+            print(f"== {name}")
+            for row in conn.exec_driver_sql(prefix + str(compiled), params):
+                print("  ", " ".join(str(column) for column in row))
+
+
+if __name__ == "__main__":
+    from Database import engine
+
+    commands = {"status": status, "migrate": migrate, "explain": explain}
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        print(__doc__)
+        sys.exit(1)
+    commands[sys.argv[1]](engine)
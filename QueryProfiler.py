@@ -0,0 +1,151 @@
+"""
+Opt-in statement profiling for N+1 and slow query hunting.
+
+With QUERY_PROFILE set, ProfileRequests records every statement a request runs
+(through the same engine events as Instrumentation.py) and logs, per request,
+statement shapes that ran N1_THRESHOLD or more times as a suspected N+1, and
+statements slower than SLOW_QUERY_MS with their parameters.
+
+QueryBudget records statements from every thread while it is open, so tests can
+hold an endpoint to a fixed number of queries:
+
+    with QueryBudget(3, max_repeats=1):
+        client.post("/getHistory", json={"userId": "u0"})
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+
+enabled = bool(os.environ.get("QUERY_PROFILE"))
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+N1_THRESHOLD = int(os.environ.get("N1_THRESHOLD", 3))
+
+logger = logging.getLogger("StumbleServerLogs.queries")
+current = ContextVar("query_profile", default=None)
+budgets = []
+budgets_lock = threading.Lock()
+
+PLACEHOLDER_LIST = re.compile(r"\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+|\$\d+)\s*,?)+\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def shape(statement):
+    """
+    Statement text with whitespace collapsed and IN lists of any length made equal.
+    """
+    return PLACEHOLDER_LIST.sub("(?)", WHITESPACE.sub(" ", statement).strip())
+
+
+class Profile:
+    def __init__(self, name=None):
+        self.name = name
+        self.statements = []  # (statement, parameters, seconds)
+
+    def record(self, statement, parameters, seconds):
+        self.statements.append((statement, parameters, seconds))
+
+    def repeated(self, threshold):
+        """
+        [(shape, count)] for shapes run at least threshold times, most repeated first.
+        """
+        counts = Counter(shape(statement) for statement, _, _ in self.statements)
+        return [(text, count) for text, count in counts.most_common() if count >= threshold]
+
+    def slow(self, threshold_ms):
+        return [entry for entry in self.statements if entry[2] * 1000 >= threshold_ms]
+
+    def report(self):
+        lines = [f"{len(self.statements)} statements"]
+        for statement, parameters, seconds in self.statements:
+            lines.append(f"  {seconds * 1000:8.2f}ms {shape(statement)} {parameters}")
+        return "\n".join(lines)
+
+
+def install(engine):
+    """
+    Listen for statements on a sync engine (an asyncio engine's sync_engine).
+    Costs one check per statement while nothing is profiling.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._profile_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = current.get()
+        if profile is None and not budgets:
+            return
+        elapsed = time.perf_counter() - context._profile_start
+        if profile is not None:
+            profile.record(statement, parameters, elapsed)
+        with budgets_lock:
+            for budget in budgets:
+                budget.record(statement, parameters, elapsed)
+
+
+def log_profile(profile):
+    for text, count in profile.repeated(N1_THRESHOLD):
+        logger.warning(f"Suspected N+1 in {profile.name}: {count} x {text}")
+    for statement, parameters, seconds in profile.slow(SLOW_QUERY_MS):
+        logger.warning(f"Slow query in {profile.name}: {seconds * 1000:.1f}ms {shape(statement)} {parameters}")
+
+
+class ProfileRequests:
+    """
+    ASGI middleware giving each request a Profile and logging what it finds.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        profile = Profile(f"{scope['method']} {scope['path']}")
+        token = current.set(profile)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current.reset(token)
+            log_profile(profile)
+
+
+class QueryBudget(Profile):
+    """
+    Context manager failing with AssertionError if more than max_queries statements
+    run inside it, or (with max_repeats) if any statement shape repeats more often.
+    """
+
+    def __init__(self, max_queries, max_repeats=None, name="query budget"):
+        super().__init__(name)
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+
+    def __enter__(self):
+        with budgets_lock:
+            budgets.append(self)
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        with budgets_lock:
+            budgets.remove(self)
+        if kind is not None:
+            return False
+        if len(self.statements) > self.max_queries:
+            raise AssertionError(f"{self.name}: expected at most {self.max_queries} queries, "
+                                 f"ran {self.report()}")
+        if self.max_repeats is not None:
+            repeated = self.repeated(self.max_repeats + 1)
+            if repeated:
+                raise AssertionError(f"{self.name}: statement repeated {repeated[0][1]} times, "
+                                     f"ran {self.report()}")
+        return False
@@ -0,0 +1,105 @@
+"""
+In-process cache of serialized analytics responses.
+
+Entries hold the JSON body already encoded (and gzipped when that pays off) with
+an ETag, so a hit costs a dict lookup and no serialization.  Entries expire
+after their TTL, or never for results over closed time buckets (callers put a
+data version in the key for those), and the least recently used ones are
+evicted past max_entries.  Each worker process keeps its
+own cache.
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi.responses import Response
+
+import Instrumentation
+
+
+FOREVER = 365 * 24 * 60 * 60  # max-age for results that can't change
+MIN_GZIP = 1024
+
+
+class CachedResponse:
+    """
+    A serialized body.  Without a ttl it never expires and is sent as immutable,
+    unless max_age is given to let clients revalidate it sooner.
+    """
+
+    def __init__(self, body, media_type="application/json", ttl=None, max_age=None):
+        self.body = body
+        self.media_type = media_type
+        self.max_age = max_age
+        self.expires = None if ttl is None else time.monotonic() + ttl
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self.gzipped = gzip.compress(body, 6) if len(body) >= MIN_GZIP else None
+
+    def expired(self, now):
+        return self.expires is not None and now >= self.expires
+
+    def headers(self):
+        if self.max_age is not None:
+            cache_control = f"public, max-age={self.max_age}"
+        elif self.expires is None:
+            cache_control = f"public, max-age={FOREVER}, immutable"
+        else:
+            cache_control = f"public, max-age={max(0, int(self.expires - time.monotonic()))}"
+        return {"ETag": self.etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+
+    def response(self, request):
+        """
+        The response for a request, 304 if it already has this version.
+        """
+        headers = self.headers()
+        if self.etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        if self.gzipped and "gzip" in request.headers.get("accept-encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            return Response(self.gzipped, media_type=self.media_type, headers=headers)
+        return Response(self.body, media_type=self.media_type, headers=headers)
+
+
+def serialize(result, default=None):
+    # The same compact encoding FastAPI uses for its JSON responses.
+    return json.dumps(result, default=default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class ResponseCache:
+    def __init__(self, max_entries=1000, default=None, max_age=None):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.default = default  # json default for values like datetimes
+        self.max_age = max_age  # for entries without a ttl, None sends them as immutable
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry.expired(time.monotonic()):
+                    del self.entries[key]
+                    entry = None
+                else:
+                    self.entries.move_to_end(key)
+        Instrumentation.cache_lookups.inc(key[0], "hit" if entry else "miss")
+        return entry
+
+    def put(self, key, result, ttl=None):
+        """
+        Serialize and store a result, ttl None keeps it until evicted.
+        """
+        entry = CachedResponse(serialize(result, self.default), ttl=ttl, max_age=None if ttl else self.max_age)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
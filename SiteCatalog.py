@@ -0,0 +1,203 @@
+"""
+Compact site catalog shared by every worker on a host.
+
+The catalog is a snapshot file of array backed site ids and urls indexed by
+dense integer slots, which each worker maps read-only, so the pages are shared
+instead of every process holding its own dict of Site objects.  Slots are only
+ever appended, which keeps per-slot data such as VisitedIndex bitmaps valid
+across snapshots.
+
+A small version file next to the snapshot is mapped by every worker.  Publishing
+writes a new snapshot, renames it into place and bumps the version, and readers
+compare one integer per request to notice and remap it.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import time
+from array import array
+
+
+HEADER = struct.Struct("=8sQII")  # magic, version, site count, live count
+MAGIC = b"STMBLCAT"
+VERSION = struct.Struct("=Q")
+
+
+class CatalogSnapshot:
+    """
+    Read-only view over one snapshot.  Sections are native uint32 arrays (the
+    file is only shared between processes on one host): id offsets, url offsets,
+    slots sorted by id and live slots, then a live flag byte per slot and the
+    utf-8 id and url blobs.
+    """
+
+    def __init__(self, data):
+        magic, self.version, count, n_live = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a site catalog snapshot")
+        self.count = count
+        view = memoryview(data)
+        pos = HEADER.size
+
+        def section(length, fmt="I"):
+            nonlocal pos
+            size = length * (4 if fmt == "I" else 1)
+            part = view[pos:pos + size]
+            pos += size
+            return part.cast(fmt) if fmt == "I" else part
+
+        self.id_offsets = section(count + 1)
+        self.url_offsets = section(count + 1)
+        self.order = section(count)
+        self.live = section(n_live)
+        self.flags = section(count, "B")
+        self.ids = section(self.id_offsets[count], "B")
+        self.urls = section(self.url_offsets[count], "B")
+
+    def __len__(self):
+        return len(self.live)
+
+    def site_id(self, slot):
+        return bytes(self.ids[self.id_offsets[slot]:self.id_offsets[slot + 1]]).decode()
+
+    def url_at(self, slot):
+        return bytes(self.urls[self.url_offsets[slot]:self.url_offsets[slot + 1]]).decode()
+
+    def slot(self, site_id):
+        """
+        Binary search the id order for a site, None if it isn't in the catalog.
+        """
+        key = site_id.encode()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            slot = self.order[mid]
+            found = bytes(self.ids[self.id_offsets[slot]:self.id_offsets[slot + 1]])
+            if found == key:
+                return slot
+            if found < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def url(self, site_id):
+        slot = self.slot(site_id)
+        return None if slot is None else self.url_at(slot)
+
+    def is_live(self, site_id):
+        slot = self.slot(site_id)
+        return slot is not None and bool(self.flags[slot])
+
+    def entries(self):
+        for slot in range(self.count):
+            yield self.site_id(slot), self.url_at(slot), bool(self.flags[slot])
+
+
+def build(version, entries):
+    """
+    Serialize [(siteId, url, live)] in slot order.
+    """
+    ids = [site_id.encode() for site_id, _, _ in entries]
+    urls = [url.encode() for _, url, _ in entries]
+
+    def offsets(blobs):
+        result, total = array("I", [0]), 0
+        for blob in blobs:
+            total += len(blob)
+            result.append(total)
+        return result
+
+    order = array("I", sorted(range(len(ids)), key=ids.__getitem__))
+    live = array("I", [slot for slot, (_, _, up) in enumerate(entries) if up])
+    flags = bytes(1 if up else 0 for _, _, up in entries)
+    return b"".join([HEADER.pack(MAGIC, version, len(ids), len(live)), offsets(ids).tobytes(),
+                     offsets(urls).tobytes(), order.tobytes(), live.tobytes(), flags, b"".join(ids), b"".join(urls)])
+
+
+class SiteCatalog:
+    def __init__(self, path="sitecatalog.bin"):
+        self.path = path
+        self.snapshot = None
+        with open(path + ".lock", "a"):
+            pass
+        with self.locked():
+            if not os.path.exists(path + ".version"):
+                # Serve a snapshot left on disk by an earlier run as it is until the next publish.
+                version = 0
+                if os.path.exists(path):
+                    with open(path, "rb") as f:
+                        version = HEADER.unpack(f.read(HEADER.size))[1]
+                with open(path + ".version", "wb") as f:
+                    f.write(VERSION.pack(version))
+        with open(path + ".version", "r+b") as f:
+            self.version_map = mmap.mmap(f.fileno(), VERSION.size)
+
+    def locked(self):
+        lock = open(self.path + ".lock", "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock  # Closing the file releases the lock
+
+    def version(self):
+        return VERSION.unpack_from(self.version_map, 0)[0]
+
+    def age(self):
+        """
+        Seconds since the snapshot on disk was published, None if there is none.
+        """
+        try:
+            return time.time() - os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return None
+
+    def current(self):
+        """
+        The snapshot to serve from, remapped if another process published since.
+        """
+        if self.snapshot is None or self.snapshot.version != self.version():
+            self.reload()
+        return self.snapshot
+
+    def reload(self):
+        if not os.path.exists(self.path):
+            self.snapshot = CatalogSnapshot(build(0, []))
+            return
+        with open(self.path, "rb") as f:
+            # Older maps stay valid for anyone still reading them and close once unreferenced.
+            self.snapshot = CatalogSnapshot(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def publish(self, sites=None, added=(), removed=()):
+        """
+        Write a new snapshot.  `sites` makes exactly those (siteId, url) pairs live,
+        otherwise `added` pairs go live and `removed` ids stop being served.
+        Known sites keep their slots either way.
+        """
+        with self.locked():
+            self.reload()
+            current = self.snapshot
+            entries = [list(entry) for entry in current.entries()]
+            slots = {entry[0]: slot for slot, entry in enumerate(entries)}
+
+            if sites is not None:
+                for entry in entries:
+                    entry[2] = False
+                added = sites
+            for site_id, url in added:
+                if site_id in slots:
+                    entries[slots[site_id]][1:] = [url, True]
+                else:
+                    slots[site_id] = len(entries)
+                    entries.append([site_id, url, True])
+            for site_id in removed:
+                if site_id in slots:
+                    entries[slots[site_id]][2] = False
+
+            version = max(current.version, self.version()) + 1
+            with open(self.path + ".tmp", "wb") as f:
+                f.write(build(version, entries))
+            os.replace(self.path + ".tmp", self.path)
+            self.version_map[:VERSION.size] = VERSION.pack(version)
+        self.reload()
+        return version
@@ -0,0 +1,169 @@
+"""
+Bulk site ingestion for admins, behind /addSites and this file's command line.
+
+    python SiteIngest.py urls.txt                  # one url per line
+    python SiteIngest.py urls.txt --no-check --reason "Partner list"
+
+Urls are normalized (scheme and host lowercased, default port and fragment
+dropped, https:// assumed without a scheme) and deduplicated within the batch
+and against Site.url and Submission.url with two IN queries per CHUNK urls.
+The new ones are checked through HealthChecker, so requests run concurrently
+with bounded parallelism overall and per host, and the reachable ones are
+inserted with an accepted Submission and their first health check in one
+transaction.  Callers publish the added sites to the catalog once, at the end.
+HealthCheck.stub_server() gives tests local urls to check.
+"""
+
+import asyncio
+import datetime
+from urllib.parse import urlsplit, urlunsplit
+from uuid import uuid4
+
+from sqlalchemy import select, insert, update
+
+from SqlAlchemyTables import *
+from Database import upsert
+from HealthCheck import HealthChecker
+
+
+CHUNK = 500  # urls per IN list
+CHECK_TIMEOUT = 5.0
+DEFAULT_PORTS = {"http": 80, "https": 443}
+DEFAULT_REASON = "Added in bulk."
+
+
+def normalize(url):
+    """
+    Canonical form of a url, None if it isn't a usable http(s) url.
+    """
+    url = url.strip()
+    if not url:
+        return None
+    if "://" not in url:
+        url = "https://" + url
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return None
+    host = parts.hostname.lower()
+    if ":" in host:
+        host = f"[{host}]"
+    if port and port != DEFAULT_PORTS[scheme]:
+        host += f":{port}"
+    return urlunsplit((scheme, host, parts.path, parts.query, ""))
+
+
+def chunks(items):
+    items = list(items)
+    for i in range(0, len(items), CHUNK):
+        yield items[i:i + CHUNK]
+
+
+async def known_urls(db, urls):
+    """
+    Return (urls that are already sites, urls that have been submitted).
+    """
+    sites, submissions = set(), set()
+    for chunk in chunks(urls):
+        sites.update(await db.scalars(select(Site.url).where(Site.url.in_(chunk))))
+        submissions.update(await db.scalars(select(Submission.url).where(Submission.url.in_(chunk))))
+    return sites, submissions
+
+
+async def ingest(db, urls, user_id, reason=DEFAULT_REASON, checker=None):
+    """
+    Add the new and reachable urls as sites, without a checker every new url is
+    added.  user_id must exist.  Returns a dict of "added" (siteId, url) pairs,
+    "duplicates" and "invalid" urls as given, and "unreachable" (url, statusCode, error).
+    """
+    result = {"added": [], "duplicates": [], "invalid": [], "unreachable": []}
+    candidates = {}  # normalized url -> url as given
+    for url in urls:
+        normal = normalize(url)
+        if normal is None:
+            result["invalid"].append(url)
+        elif normal in candidates:
+            result["duplicates"].append(url)
+        else:
+            candidates[normal] = url.strip()
+
+    # Rows added before urls were normalized may be stored as given, look for both forms.
+    sites, submissions = await known_urls(db, set(candidates) | set(candidates.values()))
+    new = []
+    for normal, given in candidates.items():
+        if normal in sites or given in sites:
+            result["duplicates"].append(given)
+        else:
+            new.append(normal)
+
+    # Hand the connection back while the urls are fetched, that can take minutes.
+    await db.commit()
+    checks = await checker.check_sites((url, url) for url in new) if checker and new else {}
+    if checks:
+        for url in new:
+            up, status, _, error = checks[url]
+            if not up:
+                result["unreachable"].append((url, status, error))
+        new = [url for url in new if checks[url][0]]
+    if not new:
+        return result
+
+    now = datetime.datetime.now()
+    added = [(str(uuid4()), url) for url in new]
+    await db.execute(insert(Site), [{"id": site_id, "url": url, "createdDate": now} for site_id, url in added])
+    # Pending or rejected submissions of the same url are accepted, like /addSite does.
+    existing = [url for normal in new for url in {normal, candidates[normal]} if url in submissions]
+    for chunk in chunks(existing):
+        await db.execute(update(Submission).where(Submission.url.in_(chunk)).values(
+            status=1, reason=reason))
+    submitted = [normal for normal in new if normal not in submissions and candidates[normal] not in submissions]
+    if submitted:
+        await db.execute(upsert(Submission).on_conflict_do_nothing(), [
+            {"url": url, "userId": user_id, "status": 1, "reason": reason, "createdDate": now} for url in submitted])
+    if checks:
+        for site_id, url in added:
+            checker.record(db, site_id, None, checks[url], now)
+    await db.commit()
+    result["added"] = added
+    return result
+
+
+async def ingest_file(path, user_id, reason, checker):
+    from Database import AsyncSession
+
+    with open(path) as f:
+        urls = [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    async with AsyncSession() as db:
+        await db.execute(upsert(User).values(id=user_id).on_conflict_do_nothing())
+        return await ingest(db, urls, user_id, reason, checker)
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    from SiteCatalog import SiteCatalog
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("source", help="File with one url per line, # starts a comment")
+    parser.add_argument("--user", default="0", help="User the accepted submissions are recorded for")
+    parser.add_argument("--reason", default=DEFAULT_REASON, help="Reason stored on the accepted submissions")
+    parser.add_argument("--no-check", action="store_true", help="Add urls without checking they respond")
+    parser.add_argument("--concurrency", type=int, default=50, help="Checks in flight at once")
+    parser.add_argument("--timeout", type=float, default=CHECK_TIMEOUT, help="Seconds to wait for each url")
+    args = parser.parse_args()
+
+    checker = None if args.no_check else HealthChecker(concurrency=args.concurrency, timeout=args.timeout)
+    result = asyncio.run(ingest_file(args.source, args.user, args.reason, checker))
+    if result["added"]:
+        # Serve them right away from the running server's catalog on this host.
+        SiteCatalog(os.environ.get("SITE_CATALOG", "sitecatalog.bin")).publish(added=result["added"])
+    for url, status, error in result["unreachable"]:
+        print(f"unreachable {url}: {error or status}")
+    for url in result["invalid"]:
+        print(f"invalid {url!r}")
+    print(f"Added {len(result['added'])}, {len(result['duplicates'])} duplicates, "
+          f"{len(result['invalid'])} invalid, {len(result['unreachable'])} unreachable")
@@ -0,0 +1,114 @@
+"""
+Popularity weighted site sampling for /getSite.
+
+Each live site is weighted by its like rate, smoothed towards the overall like
+rate so sites with few visits aren't swung by a couple of likes:
+
+    (likes + PRIOR_VISITS * overall rate) / (visits + PRIOR_VISITS)
+
+The weights are turned into an alias table (Vose's method) over catalog slots,
+which draws a site in constant time with one random index and one coin flip.
+Counts are reread every REFRESH_INTERVAL from SiteStats, which the hourly
+rollup refreshes once for all workers (see MetricsRollup.refresh_site_stats),
+and the table is rebuilt when the catalog changes; sampling always uses the last
+complete table, so callers must still reject sites that are visited or no
+longer live.
+"""
+
+import datetime
+import random
+import time
+from array import array
+
+from SqlAlchemyTables import *
+
+
+class SiteWeights:
+    PRIOR_VISITS = 20
+    REFRESH_INTERVAL = 15 * 60
+    CHECK_INTERVAL = 60
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.counts = {}  # site id -> (visits, likes)
+        self.overall = 0.0
+        self.version = None  # catalog version the table was built from
+        self.table = None  # (slots, probabilities, aliases)
+
+    def __len__(self):
+        return len(self.table[0]) if self.table else 0
+
+    def load_counts(self, session):
+        counts = {}
+        visits = likes = 0
+        for site_id, n_visits, n_likes in session.query(
+                SiteStats.siteId, SiteStats.visits, SiteStats.likes).yield_per(10000):
+            counts[site_id] = (n_visits, n_likes)
+            visits += n_visits
+            likes += n_likes
+        self.counts = counts
+        self.overall = likes / visits if visits else 0.0
+
+    def weight(self, site_id):
+        visits, likes = self.counts.get(site_id, (0, 0))
+        return (likes + self.PRIOR_VISITS * self.overall) / (visits + self.PRIOR_VISITS)
+
+    def build(self):
+        """
+        Build the alias table for the live sites of the current catalog.
+        """
+        snapshot = self.catalog.current()
+        slots = array("I", snapshot.live)
+        n = len(slots)
+        weights = [self.weight(snapshot.site_id(slot)) for slot in slots]
+        total = sum(weights)
+        if not n or total <= 0:
+            # Nothing liked yet, every site is equally likely.
+            weights, total = [1.0] * n, float(n)
+
+        probabilities = array("d", [0.0]) * n
+        aliases = array("I", [0]) * n
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            probabilities[less] = scaled[less]
+            aliases[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+        for i in small + large:
+            probabilities[i] = 1.0
+
+        self.table = (slots, probabilities, aliases)  # Swapped in whole for readers
+        self.version = snapshot.version
+
+    def sample(self):
+        """
+        A catalog slot drawn by weight, None before the first build.
+        """
+        table = self.table
+        if not table or not table[0]:
+            return None
+        slots, probabilities, aliases = table
+        i = random.randrange(len(slots))
+        return slots[i] if random.random() < probabilities[i] else slots[aliases[i]]
+
+    def run_forever(self, sm, heartbeat=None):
+        refreshed = None
+        while True:
+            try:
+                if refreshed is None or time.monotonic() - refreshed >= self.REFRESH_INTERVAL:
+                    session = sm()
+                    self.load_counts(session)
+                    session.close()
+                    refreshed = time.monotonic()
+                    self.build()
+                    print(f"{datetime.datetime.utcnow()}: rebuilt site weights for {len(self)} sites")
+                elif self.catalog.current().version != self.version:
+                    self.build()
+                if heartbeat:
+                    heartbeat()
+            except Exception as e:
+                print(f"{datetime.datetime.utcnow()}: refreshing site weights failed: {e}")
+            time.sleep(self.CHECK_INTERVAL)
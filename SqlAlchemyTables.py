@@ -1,6 +1,6 @@
 import sqlalchemy, datetime
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, Float, Index, LargeBinary
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
@@ -8,6 +8,9 @@ Base = declarative_base()
 
 class User(Base):
     __tablename__ = "User"
+    __table_args__ = (
+        Index("ix_user_created", "createdDate"),
+    )
     id = Column(String, primary_key=True)
     createdDate = Column(DateTime, server_default=func.now())
 
@@ -25,6 +28,11 @@ class Site(Base):
 
 class Visit(Base):
     __tablename__ = "Visit"
+    __table_args__ = (
+        # Ordered like /getHistory pages, newest first with siteId breaking ties.
+        Index("ix_visit_user_created_site", "userId", "createdDate", "siteId"),
+        Index("ix_visit_created_liked", "createdDate", "liked"),
+    )
 
     siteId = Column(String, ForeignKey("Site.id"), primary_key=True)
     userId = Column(String, ForeignKey("User.id"), primary_key=True)
@@ -36,10 +44,29 @@ class Visit(Base):
     site = relationship("Site", back_populates="visits")
 
     def __repr__(self):
-        return f"<Visit {self.userId}:{self.site.url}, {self.createdDate}>"
+        return f"<Visit {self.userId}:{self.siteId}, {self.createdDate}>"
+
+class ArchivedVisit(Base):
+    """
+    Visits older than the hot window, moved out of Visit by VisitArchive.py.
+    """
+    __tablename__ = "ArchivedVisit"
+    __table_args__ = (
+        Index("ix_archivedvisit_user_created_site", "userId", "createdDate", "siteId"),
+        Index("ix_archivedvisit_created_liked", "createdDate", "liked"),
+    )
+
+    siteId = Column(String, ForeignKey("Site.id"), primary_key=True)
+    userId = Column(String, ForeignKey("User.id"), primary_key=True)
+    liked = Column(Boolean, default=False)
+    createdDate = Column(DateTime)
+    updatedDate = Column(DateTime, onupdate=func.now())
 
 class Submission(Base):
     __tablename__ = "Submission"
+    __table_args__ = (
+        Index("ix_submission_status_created", "status", "createdDate", "url"),
+    )
 
     userId = Column(String, ForeignKey("User.id"))
     url = Column(String, primary_key=True)
@@ -61,7 +88,7 @@ class Submission(Base):
 
     def j(self):
         return {
-            "user": self.user.id,
+            "user": self.userId,
             "url": self.url,
             "status": self.status,
             "reason": self.reason,
@@ -72,6 +99,9 @@ class Submission(Base):
 
 class Metric(Base):
     __tablename__ = "Metric"
+    __table_args__ = (
+        Index("ix_metric_description_time", "description", "time"),
+    )
 
     HOURLY_NEW_USERS = "Hourly New Users"
     HOURLY_NEW_SITES = "Hourly Sites"
@@ -82,4 +112,115 @@ class Metric(Base):
     createdDate = Column(DateTime, server_default=func.now())
     time = Column(DateTime)
     amount = Column(Integer, default=0)
-    description = Column(String)
\ No newline at end of file
+    description = Column(String)
+
+class MetricSketch(Base):
+    """
+    HyperLogLog sketch of the users seen during one hour, see HyperLogLog.py.
+    Sketches merge, so unique users over any range of hours can be estimated from them.
+    """
+    __tablename__ = "MetricSketch"
+
+    HOURLY_USERS = "Hourly Users"
+
+    time = Column(DateTime, primary_key=True)
+    description = Column(String, primary_key=True)
+    registers = Column(LargeBinary)
+    updatedDate = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class SiteStats(Base):
+    """
+    Visits and likes of each site, refreshed by the hourly rollup for SiteWeights.
+    """
+    __tablename__ = "SiteStats"
+
+    siteId = Column(String, ForeignKey("Site.id"), primary_key=True)
+    visits = Column(Integer, default=0)
+    likes = Column(Integer, default=0)
+
+
+class SiteHealth(Base):
+    """
+    Latest health check result for a site and when to check it next.
+    """
+    __tablename__ = "SiteHealth"
+    __table_args__ = (
+        Index("ix_sitehealth_next_check", "nextCheck"),
+    )
+
+    siteId = Column(String, ForeignKey("Site.id"), primary_key=True)
+    up = Column(Boolean, default=True)
+    statusCode = Column(Integer)
+    failures = Column(Integer, default=0)  # Consecutive failed checks
+    flaps = Column(Float, default=0)  # Decaying count of up/down changes
+    interval = Column(Integer)  # Seconds between checks
+    lastChecked = Column(DateTime)
+    nextCheck = Column(DateTime)
+
+
+class SiteCheck(Base):
+    """
+    One health check of a site, kept as history.
+    """
+    __tablename__ = "SiteCheck"
+    __table_args__ = (
+        Index("ix_sitecheck_site_time", "siteId", "time"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    siteId = Column(String, ForeignKey("Site.id"))
+    time = Column(DateTime)
+    up = Column(Boolean)
+    statusCode = Column(Integer)
+    latency = Column(Float)  # Milliseconds
+    error = Column(String)
+
+
+class Reservation(Base):
+    """
+    A site /getSites handed to a user, not offered to them again until it expires.
+    Kept in the database so every worker sees them.
+    """
+    __tablename__ = "Reservation"
+    __table_args__ = (
+        Index("ix_reservation_expires", "expires"),
+    )
+
+    userId = Column(String, ForeignKey("User.id"), primary_key=True)
+    siteId = Column(String, ForeignKey("Site.id"), primary_key=True)
+    expires = Column(DateTime)
+
+
+class SchemaVersion(Base):
+    """
+    Migrations from Migrations.py that have been applied to this database.
+    """
+    __tablename__ = "SchemaVersion"
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String)
+    appliedDate = Column(DateTime, server_default=func.now())
+
+
+class DataVersion(Base):
+    """
+    Bumped whenever data under results that were already final is rewritten, so
+    servers drop what they cached from it.  One row per source of analytics.
+    """
+    __tablename__ = "DataVersion"
+
+    METRICS = "metrics"  # Metric and MetricSketch, written by MetricsRollup.py
+    VISITS = "visits"
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, default=0)
+    updatedDate = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    @classmethod
+    def bump(cls, session, name):
+        """
+        Takes a Session or a Connection, the caller commits.
+        """
+        if not session.execute(sqlalchemy.update(cls).where(cls.name == name).values(version=cls.version + 1)).rowcount:
+            session.execute(sqlalchemy.insert(cls).values(name=name, version=1))
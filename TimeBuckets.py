@@ -0,0 +1,59 @@
+"""
+Helpers for counting rows in fixed width time buckets inside the database.
+
+bucket_index numbers the bucket a timestamp column falls into so that a single
+GROUP BY query can return every bucket of a range, and zero_fill turns the
+sparse result back into one (time, amount) pair per bucket.
+"""
+
+import calendar
+import datetime
+
+from sqlalchemy import cast, extract, func, Integer
+
+
+def epoch(d):
+    return calendar.timegm(d.timetuple())
+
+
+def bucket_count(start, end, minutes):
+    """
+    Number of buckets needed to cover [start, end).
+    """
+    width = minutes * 60
+    return max(0, -(-int((end - start).total_seconds()) // width))
+
+
+def bucket_index(column, start, minutes, dialect):
+    """
+    SQL expression for the index of the `minutes` wide bucket after `start` that
+    `column` falls in.  Only meaningful for rows with column >= start.
+    """
+    width = minutes * 60
+    offset = epoch(start)
+    if dialect == "postgresql":
+        return cast(func.floor((extract("epoch", column) - offset) / width), Integer)
+    if dialect == "sqlite":
+        # Integer division of whole seconds, no float rounding at bucket edges.
+        return (cast(func.strftime("%s", column), Integer) - offset) // width
+    raise ValueError(f"Time buckets are not supported for {dialect}")
+
+
+def bucket_range(column, start, end, minutes):
+    """
+    Filter for the rows that fall in one of the buckets covering [start, end).
+    """
+    last = start + datetime.timedelta(minutes=minutes * bucket_count(start, end, minutes))
+    return column >= start, column < last
+
+
+def zero_fill(rows, start, end, minutes, columns=1):
+    """
+    Turn (bucket index, amount...) rows into a (time, amount...) entry for every
+    bucket covering [start, end), using 0 for buckets with no rows.
+    """
+    found = {int(row[0]): tuple(row[1:]) for row in rows}
+    empty = (0,) * columns
+    step = datetime.timedelta(minutes=minutes)
+    return [(start + step * i,) + tuple(int(v or 0) for v in found.get(i, empty))
+            for i in range(bucket_count(start, end, minutes))]
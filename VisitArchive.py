@@ -0,0 +1,186 @@
+"""
+Hot and cold storage for visits.
+
+Visit keeps the hot window, the last HOT_DAYS rounded down to a whole month.
+archive() moves every older month into ArchivedVisit: it is copied a day per
+transaction with INSERT ... SELECT (rows never pass through Python), written to
+ARCHIVE_DIR/visits-YYYY-MM.ndjson.gz as a compressed snapshot, and only then
+deleted from Visit.  Copies skip rows already archived, so an interrupted run
+simply redoes the month.  Snapshots reflect ArchivedVisit at archival time.
+Runs take a lock on ARCHIVE_DIR, so with ARCHIVE_VISITS set in every worker
+only one of them archives at a time.
+
+Reads that need a user's whole history go through user_visits() or
+all_visits(), both tables as one subquery with Visit's columns.  Analytics
+over a time range use visits_since(start), which is Visit alone whenever the
+range starts inside the hot window.
+
+    python VisitArchive.py                  # archive months older than the hot window
+
+The window is read from VISIT_HOT_DAYS by both the server and this script, so
+they must be given the same value.
+"""
+
+import datetime
+import fcntl
+import gzip
+import json
+import os
+
+from sqlalchemy import select, func, union_all
+
+from SqlAlchemyTables import *
+
+
+HOT_DAYS = int(os.environ.get("VISIT_HOT_DAYS", 90))
+ARCHIVE_DIR = os.environ.get("VISIT_ARCHIVE_DIR", "archive")
+COLUMNS = ("siteId", "userId", "liked", "createdDate", "updatedDate")
+TABLES = (Visit.__table__, ArchivedVisit.__table__)
+
+
+def floor_month(d):
+    return datetime.datetime(d.year, d.month, 1)
+
+
+def next_month(d):
+    return datetime.datetime(d.year + d.month // 12, d.month % 12 + 1, 1)
+
+
+def hot_since(now=None):
+    """
+    Start of the hot window.  Visits from here on are always in Visit, older
+    ones may have been archived.
+    """
+    now = now or datetime.datetime.now()
+    return floor_month(now - datetime.timedelta(days=HOT_DAYS))
+
+
+def columns(table):
+    return [table.c[name] for name in COLUMNS]
+
+
+def all_visits():
+    """
+    Every visit, hot and archived, as a subquery with Visit's columns.
+    """
+    return union_all(*(select(*columns(table)) for table in TABLES)).subquery("visits")
+
+
+def user_visits(user_id):
+    """
+    One user's visits from both tables.  The filter is applied to each table
+    so both can use their userId index.
+    """
+    return union_all(*(select(*columns(table)).where(table.c.userId == user_id)
+                       for table in TABLES)).subquery("visits")
+
+
+def visits_since(start, now=None):
+    """
+    What to query for visits created from start on: Visit when that is inside
+    the hot window, otherwise both tables.
+    """
+    return Visit.__table__ if start >= hot_since(now) else all_visits()
+
+
+def days(month):
+    day = month
+    while day < next_month(month):
+        yield day, day + datetime.timedelta(days=1)
+        day += datetime.timedelta(days=1)
+
+
+def copy_range(session, start, end):
+    # Imported here, Database connects to DB_STRING and MetricsRollup imports this module without one.
+    from Database import upsert
+
+    hot = Visit.__table__
+    session.execute(upsert(ArchivedVisit).from_select(COLUMNS, select(*columns(hot)).where(
+        hot.c.createdDate >= start, hot.c.createdDate < end)).on_conflict_do_nothing())
+    session.commit()
+
+
+def delete_range(session, start, end):
+    hot = Visit.__table__
+    deleted = session.execute(hot.delete().where(hot.c.createdDate >= start, hot.c.createdDate < end)).rowcount
+    session.commit()
+    return deleted
+
+
+def snapshot_path(month, directory=ARCHIVE_DIR):
+    return os.path.join(directory, f"visits-{month:%Y-%m}.ndjson.gz")
+
+
+def write_snapshot(session, month, directory=ARCHIVE_DIR, batch_size=10000):
+    """
+    Write one archived month as gzipped JSON lines, replacing the file atomically.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(month, directory)
+    cold = ArchivedVisit.__table__
+    rows = session.execute(select(*columns(cold)).where(
+        cold.c.createdDate >= month, cold.c.createdDate < next_month(month)).order_by(
+        cold.c.createdDate, cold.c.siteId, cold.c.userId).execution_options(yield_per=batch_size))
+    written = 0
+    with gzip.open(path + ".tmp", "wt", compresslevel=9) as f:
+        for row in rows:
+            f.write(json.dumps(dict(zip(COLUMNS, row)), default=str, separators=(",", ":")) + "\n")
+            written += 1
+    os.replace(path + ".tmp", path)
+    return written
+
+
+def locked(directory):
+    """
+    An exclusive lock on the snapshot directory, None if another process holds it.
+    """
+    os.makedirs(directory, exist_ok=True)
+    lock = open(os.path.join(directory, ".lock"), "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock  # Closing the file releases the lock
+
+
+def archive(session, now=None, directory=ARCHIVE_DIR):
+    """
+    Archive every month before the hot window that still has rows in Visit.
+    Returns the number of visits moved.  Only one process on a host archives at
+    a time, the others return 0 right away.
+    """
+    lock = locked(directory)
+    if lock is None:
+        print(f"{datetime.datetime.utcnow()}: another process is archiving visits, skipping")
+        return 0
+    with lock:
+        cutoff = hot_since(now)
+        total = 0
+        while True:
+            first = session.query(func.min(Visit.createdDate)).filter(Visit.createdDate < cutoff).scalar()
+            if not first:
+                return total
+            month = floor_month(first)
+            # Copy, snapshot, then delete, so a run that stops part way leaves the month in Visit to redo.
+            for start, end in days(month):
+                copy_range(session, start, end)
+            rows = write_snapshot(session, month, directory)
+            moved = sum(delete_range(session, start, end) for start, end in days(month))
+            print(f"{datetime.datetime.utcnow()}: archived {moved} visits from {month:%Y-%m}, "
+                  f"snapshot of {rows} visits in {snapshot_path(month, directory)}")
+            total += moved
+
+
+if __name__ == "__main__":
+    import argparse
+    from Database import Session
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dir", default=ARCHIVE_DIR, help="Where to write the monthly snapshots")
+    args = parser.parse_args()
+
+    session = Session()
+    Base.metadata.create_all(session.get_bind(), tables=[ArchivedVisit.__table__])
+    print(f"Moved {archive(session, directory=args.dir)} visits")
+    session.close()
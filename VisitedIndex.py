@@ -0,0 +1,143 @@
+"""
+In-process index of the sites each user has already visited.
+
+Every user is stored as a bitmap over the dense site slots of the SiteCatalog,
+so choosing an unvisited site for /getSite does not need to read the user's
+whole Visit history or build a set per request.  Catalog slots never move, so
+bitmaps stay valid when a new catalog snapshot is published.
+"""
+
+import random
+import threading
+from collections import OrderedDict
+
+
+class VisitedIndex:
+    # Returned by choose for users that aren't loaded, or were evicted since.
+    UNLOADED = object()
+    # Random probes before falling back to a scan of the live slots.  A user who
+    # has seen 90% of the catalog only reaches the scan ~3% of the time.
+    PROBES = 32
+
+    def __init__(self, catalog, max_users=50000):
+        self.lock = threading.Lock()
+        self.catalog = catalog
+        self.max_users = max_users
+        self.users = OrderedDict()  # user id -> bytearray bitmap, in LRU order
+
+    def __len__(self):
+        return len(self.users)
+
+    @staticmethod
+    def _test(bitmap, slot):
+        byte = slot >> 3
+        return byte < len(bitmap) and bitmap[byte] & (1 << (slot & 7))
+
+    @staticmethod
+    def _set(bitmap, slot):
+        byte = slot >> 3
+        if byte >= len(bitmap):
+            bitmap.extend(bytes(byte - len(bitmap) + 1))
+        bitmap[byte] |= 1 << (slot & 7)
+
+    def has_user(self, user_id):
+        return user_id in self.users
+
+    def load(self, user_id, site_ids, replace=False):
+        """
+        Store a user's visited sites as read from the database.  Unless replace
+        is set an already loaded user is left alone, so a warm load that races
+        with a request never drops a visit the request just recorded.
+        Sites that aren't in the catalog can't be served and are skipped.
+        """
+        snapshot = self.catalog.current()
+        with self.lock:
+            if user_id in self.users and not replace:
+                return
+            bitmap = bytearray()
+            for site_id in site_ids:
+                slot = snapshot.slot(site_id)
+                if slot is not None:
+                    self._set(bitmap, slot)
+            self.users[user_id] = bitmap
+            self.users.move_to_end(user_id)
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+
+    def warm(self, rows):
+        """
+        Bulk load from (userId, siteId) rows sorted by userId.
+        """
+        user_id, site_ids = None, []
+        for row_user, site_id in rows:
+            if row_user != user_id:
+                if user_id is not None:
+                    self.load(user_id, site_ids)
+                user_id, site_ids = row_user, []
+            site_ids.append(site_id)
+        if user_id is not None:
+            self.load(user_id, site_ids)
+
+    def add(self, user_id, site_id):
+        """
+        Record a visit for a loaded user.  Unloaded users are ignored, they
+        will be read from the database when next needed.
+        """
+        slot = self.catalog.current().slot(site_id)
+        with self.lock:
+            bitmap = self.users.get(user_id)
+            if bitmap is not None and slot is not None:
+                self._set(bitmap, slot)
+
+    def visited(self, user_id, site_id):
+        bitmap = self.users.get(user_id)
+        slot = self.catalog.current().slot(site_id)
+        return bool(bitmap is not None and slot is not None and self._test(bitmap, slot))
+
+    def choose(self, user_id, weights=None, exclude=()):
+        """
+        Return a random live site the user has not visited, or None if they
+        have seen them all.  Site ids in exclude are skipped.  Returns UNLOADED
+        if the user isn't loaded, as happens when other users push them out of
+        the LRU between load and choose, callers then load them again.  With
+        SiteWeights sites are drawn by weight, falling back to uniform for users
+        who keep drawing sites they have seen.
+        """
+        snapshot = self.catalog.current()
+        live = snapshot.live
+        skip = set(slot for slot in map(snapshot.slot, exclude) if slot is not None)
+        with self.lock:
+            bitmap = self.users.get(user_id)
+            if bitmap is None:
+                return self.UNLOADED
+            self.users.move_to_end(user_id)
+        if not live:
+            return None
+
+        def unseen(slot):
+            return not self._test(bitmap, slot) and slot not in skip
+
+        if weights is not None:
+            for _ in range(self.PROBES):
+                slot = weights.sample()
+                if slot is None:
+                    break
+                # The table can lag the catalog, skip sites that went down since.
+                if slot < snapshot.count and snapshot.flags[slot] and unseen(slot):
+                    return snapshot.site_id(slot)
+
+        for _ in range(self.PROBES):
+            slot = live[random.randrange(len(live))]
+            if unseen(slot):
+                return snapshot.site_id(slot)
+
+        # Most of the catalog has been seen, count what is left and pick one.
+        remaining = sum(1 for slot in live if unseen(slot))
+        if remaining == 0:
+            return None
+        pick = random.randrange(remaining)
+        for slot in live:
+            if unseen(slot):
+                if pick == 0:
+                    return snapshot.site_id(slot)
+                pick -= 1
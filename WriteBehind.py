@@ -0,0 +1,163 @@
+"""
+Optional write-behind buffer for Visit writes.
+
+With WRITE_BEHIND set, /getSite and /like record visits and like toggles here
+instead of committing per request.  Writes are coalesced per (siteId, userId)
+and flushed as bulk upserts when the buffer reaches max_pending or every
+interval seconds, and drain() flushes what is left on shutdown.  Pending
+writes stay readable until they are committed so the read paths can merge them.
+
+Failed flushes keep their writes, so while the database is down the buffer would
+only grow.  Once it holds max_buffered visits, visit() and like() refuse writes
+for visits not already buffered and the caller commits those itself.
+"""
+
+import asyncio
+import datetime
+import logging
+
+from sqlalchemy import func
+
+from SqlAlchemyTables import *
+from Database import upsert
+import Instrumentation
+
+
+logger = logging.getLogger('StumbleServerLogs')
+
+
+class WriteBehind:
+    def __init__(self, sm, max_pending=500, interval=1.0, max_buffered=10000):
+        self.sm = sm
+        self.max_pending = max_pending
+        self.max_buffered = max_buffered
+        self.overflowing = False
+        self.interval = interval
+        self.pending = {}  # userId -> {siteId: entry}
+        self.flushing = {}  # Same shape, being committed right now
+        self.size = 0
+        self.lock = asyncio.Lock()
+        self.flush_task = None
+        self.timer = None
+
+    def entry(self, user_id, site_id):
+        """
+        The newest buffered write for a visit, or None.
+        """
+        entry = self.pending.get(user_id, {}).get(site_id)
+        return entry if entry is not None else self.flushing.get(user_id, {}).get(site_id)
+
+    def visits(self, user_id):
+        """
+        Buffered new visits for a user as (siteId, createdDate, liked), newest first.
+        """
+        merged = dict(self.flushing.get(user_id, {}))
+        merged.update(self.pending.get(user_id, {}))
+        visits = [(site_id, e["createdDate"], bool(e["liked"])) for site_id, e in merged.items() if e["insert"]]
+        return sorted(visits, key=lambda v: v[1], reverse=True)
+
+    def _put(self, user_id, site_id):
+        """
+        The pending entry for a visit, or None when the buffer is full and the
+        visit has no buffered write yet, so entry() is None for every refused one.
+        """
+        entries = self.pending.setdefault(user_id, {})
+        entry = entries.get(site_id)
+        if entry is None:
+            previous = self.flushing.get(user_id, {}).get(site_id)
+            if previous is None and self.size >= self.max_buffered:
+                if not self.overflowing:
+                    logger.warning(f"Write-behind buffer holds {self.size} visits, writing through until it flushes")
+                    self.overflowing = True
+                Instrumentation.write_behind.inc("written_through")
+                return None
+            entry = dict(previous) if previous else {
+                "createdDate": datetime.datetime.now(), "liked": None, "insert": False}
+            entries[site_id] = entry
+            self.size += 1
+            Instrumentation.write_behind.inc("buffered")
+            if self.size >= self.max_pending and (not self.flush_task or self.flush_task.done()):
+                self.flush_task = asyncio.get_running_loop().create_task(self.flush())
+        return entry
+
+    def visit(self, user_id, site_id):
+        """
+        Buffer a new visit.  False if the buffer is full and it must be written now.
+        """
+        entry = self._put(user_id, site_id)
+        if entry is None:
+            return False
+        entry["insert"] = True
+        return True
+
+    def like(self, user_id, site_id, liked):
+        """
+        Buffer a like toggle.  False if the buffer is full and it must be written now.
+        """
+        entry = self._put(user_id, site_id)
+        if entry is None:
+            return False
+        entry["liked"] = liked
+        return True
+
+    async def flush(self):
+        """
+        Commit everything buffered so far in one transaction.
+        """
+        async with self.lock:
+            if not self.pending:
+                return
+            self.flushing, self.pending, self.size = self.pending, {}, 0
+            try:
+                await self._write(self.flushing)
+                self.overflowing = False
+            except Exception:
+                logger.exception("Write-behind flush failed, keeping writes buffered")
+                self._restore(self.flushing)
+            finally:
+                self.flushing = {}
+
+    async def _write(self, buffered):
+        inserts, likes = [], []
+        for user_id, entries in buffered.items():
+            for site_id, e in entries.items():
+                row = {"siteId": site_id, "userId": user_id,
+                       "createdDate": e["createdDate"], "liked": bool(e["liked"])}
+                (likes if e["liked"] is not None else inserts).append(row)
+
+        async with self.sm() as session:
+            if inserts:
+                await session.execute(upsert(Visit).on_conflict_do_nothing(), inserts)
+            if likes:
+                statement = upsert(Visit)
+                await session.execute(statement.on_conflict_do_update(
+                    index_elements=[Visit.siteId, Visit.userId],
+                    set_={"liked": statement.excluded.liked, "updatedDate": func.now()}), likes)
+            await session.commit()
+
+    def _restore(self, buffered):
+        for user_id, entries in buffered.items():
+            for site_id, e in entries.items():
+                newer = self.pending.setdefault(user_id, {}).get(site_id)
+                if newer is None:
+                    self.pending[user_id][site_id] = e
+                    self.size += 1
+                else:
+                    newer["insert"] = newer["insert"] or e["insert"]
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            # Shielded so cancelling the timer never interrupts a commit half way.
+            await asyncio.shield(self.flush())
+
+    def start(self):
+        self.timer = asyncio.get_running_loop().create_task(self.run())
+
+    async def drain(self):
+        """
+        Stop the timer and flush everything that is left.
+        """
+        if self.timer:
+            self.timer.cancel()
+        await self.flush()
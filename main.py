@@ -1,60 +1,189 @@
-from typing import Optional
+from typing import Optional, List, Annotated
 from pydantic import BaseModel
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends, Request, Query
 import datetime
-import random
+import base64
+import json
 from multiprocessing import Lock
 from uuid import uuid4
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, PlainTextResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
 
 import os
 
 import logging
 import logging.handlers as handlers
 
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import select, func, distinct, or_, tuple_
+from sqlalchemy.orm import joinedload, aliased
 from SqlAlchemyTables import *
+from Database import engine, async_engine, Session, AsyncSession, get_db, upsert
+from VisitedIndex import VisitedIndex
+from SiteCatalog import SiteCatalog
+from SiteWeights import SiteWeights
+from HealthCheck import HealthChecker
+from WriteBehind import WriteBehind
+import MetricsRollup
+import SiteIngest
+import VisitArchive
+import HyperLogLog
+import Instrumentation
+import QueryProfiler
+import StructuredLog
+import ResponseCache
+from TimeBuckets import bucket_index, bucket_range, bucket_count, zero_fill
 
-import requests
 import time
 import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 
 
 class Helper:
     busy = Lock()
-    all_sites = set()
     secret = os.environ["SECRET_KEY"]
     date_format = "%Y-%m-%dT%h:%m:%s"
+    max_known_users = 100000
+    # A catalog snapshot on disk younger than this was just published by another
+    # worker on this host, so a starting worker serves it without reloading sites.
+    catalog_max_age = int(os.environ.get("CATALOG_MAX_AGE", 10 * 60))
 
     def __init__(self, sm):
         self.sm = sm
+        self.catalog = SiteCatalog(os.environ.get("SITE_CATALOG", "sitecatalog.bin"))
+        self.catalog_ready = threading.Event()
+        self.warmed = threading.Event()
+        self.visited = VisitedIndex(self.catalog)
+        self.known_users = OrderedDict()  # User ids known to exist, in LRU order
+        self.sketches = HyperLogLog.HourlySketches()
+        self.checker = HealthChecker(sm, on_change=self.sites_checked)
         self.worker = threading.Thread(target=self.update, daemon=True)
         self.update_worker = threading.Thread(
             target=self.update_metrics, daemon=True)
+        self.warm_worker = threading.Thread(
+            target=self.warm_up, daemon=True)
+        self.sketch_worker = threading.Thread(
+            target=self.persist_sketches, daemon=True)
+        # Weighted stumbles are opt in, they read SiteStats every 15 minutes.
+        self.weights = SiteWeights(self.catalog) if os.environ.get("WEIGHTED_SITES") else None
+        self.metrics_page = None
+
+    def start(self):
+        """
+        Start the background workers.  Nothing here waits on the size of the
+        catalog: loading sites and warming the visited index run in warm_up.
+        """
+        self.metrics_page = ResponseCache.CachedResponse(open("metrics.html").read().encode(), "text/html",
+                                                         max_age=60 * 60)
+        self.warm_worker.start()
+        if self.weights is not None:
+            threading.Thread(target=self.weights.run_forever, args=(self.sm, lambda: Instrumentation.heartbeat("weights")),
+                             daemon=True).start()
+        # Archiving moves rows out of Visit for good, so it is opt in too.
+        if os.environ.get("ARCHIVE_VISITS"):
+            threading.Thread(target=self.archive_visits, daemon=True).start()
         self.worker.start()
         self.update_worker.start()
-        self.metrics_file = open("metrics.html").read()
-        self.memo = {}
+        self.sketch_worker.start()
+
+    def ready(self):
+        return self.catalog_ready.is_set() and self.warmed.is_set()
 
     def update(self):
-        time.sleep(100)
+        self.checker.run_forever(heartbeat=lambda: Instrumentation.heartbeat("update"))
+
+    def load_sites(self):
+        """
+        Publish every site that isn't known to be down as the shared catalog.
+        """
+        session = self.sm()
+        sites = session.query(Site.id, Site.url).outerjoin(
+            SiteHealth, SiteHealth.siteId == Site.id).filter(or_(SiteHealth.up == None, SiteHealth.up == True))
+        self.catalog.publish(sites=[(site_id, url) for site_id, url in sites])
+        session.close()
+
+    def sites_checked(self, results):
+        """
+        Apply a pass of health check results to the catalog, publishing only if something changed.
+        """
+        snapshot = self.catalog.current()
+        added = [(site_id, url) for site_id, url, up in results if up and not snapshot.is_live(site_id)]
+        removed = [site_id for site_id, url, up in results if not up and snapshot.is_live(site_id)]
+        if added or removed:
+            self.catalog.publish(added=added, removed=removed)
+
+    def known_user(self, user_id):
+        if user_id in self.known_users:
+            self.known_users.move_to_end(user_id)
+            return True
+        return False
+
+    def add_known_user(self, user_id):
+        self.known_users[user_id] = None
+        if len(self.known_users) > self.max_known_users:
+            self.known_users.popitem(last=False)
+
+    def warm_up(self):
+        """
+        Serve the catalog snapshot on disk right away, refresh it from the database
+        unless another worker just did, then warm the visited index.
+        """
+        age = self.catalog.age()
+        if age is not None:
+            self.catalog_ready.set()
+        while True:
+            try:
+                if age is None or age > self.catalog_max_age:
+                    self.load_sites()
+                self.catalog_ready.set()
+                self.warm_visited()
+                break
+            except Exception as e:
+                print(f"{datetime.datetime.utcnow()}: warming up failed, retrying: {e}")
+                time.sleep(10)
+        self.warmed.set()
+
+    def warm_visited(self, hours=24):
+        """
+        Load the visited index for users active in the last day so their next stumble doesn't have to.
+        """
+        session = self.sm()
+        since = datetime.datetime.now() - datetime.timedelta(hours=hours)
+        active = session.query(Visit.userId).filter(
+            Visit.createdDate >= since).distinct().limit(self.visited.max_users)
+        visits = VisitArchive.all_visits()
+        rows = session.query(visits.c.userId, visits.c.siteId).filter(
+            visits.c.userId.in_(active.scalar_subquery())).order_by(visits.c.userId)
+        self.visited.warm(rows.yield_per(10000))
+        session.close()
+        print(f"{datetime.datetime.utcnow()}: warmed visited index for {len(self.visited)} users")
+
+    def persist_sketches(self):
+        while True:
+            time.sleep(60)
+            session = self.sm()
+            try:
+                self.sketches.persist(session)
+                Instrumentation.heartbeat("persist_sketches")
+            except Exception as e:
+                print(f"{datetime.datetime.utcnow()}: saving sketches failed: {e}")
+            session.close()
+
+    def archive_visits(self):
+        """
+        Once a day, move visits older than the hot window to ArchivedVisit, see VisitArchive.py.
+        """
         while True:
+            time.sleep(60 * 60)
             session = self.sm()
-            sites = session.query(Site).all()
-            up_sites = []
-            for site in sites:
-                try:
-                    r = requests.get(site.url, allow_redirects=True)
-                    if r.status_code < 400:
-                        up_sites.append(site)
-                except:
-                    pass
-            print(
-                f"{datetime.datetime.utcnow()}: {len(up_sites)} / {len(sites)} sites up")
-            self.all_sites = {site.id: site for site in up_sites}
-            time.sleep(86400)  # Run this once per day.
+            try:
+                VisitArchive.archive(session)
+                Instrumentation.heartbeat("archive_visits")
+            except Exception as e:
+                print(f"{datetime.datetime.utcnow()}: archiving visits failed: {e}")
+            session.close()
+            time.sleep(23 * 60 * 60)
 
     def update_metrics(self):
         """
@@ -67,48 +196,12 @@ class Helper:
             time.sleep(60 * 60)  # Run this once per hour.
 
             session = self.sm()
-
-            last_metric = session.query(Metric).order_by(
-                Metric.time.desc()).first()
-            cur = datetime.datetime(
-                last_metric.time.year, last_metric.time.month, last_metric.time.day, last_metric.time.hour)
-            now_time = datetime.datetime.now()
-            metrics = []
-
-            while cur < now_time:
-                next_time = cur + datetime.timedelta(hours=1)
-
-                visits = session.query(Visit).filter(
-                    Visit.createdDate >= cur, Visit.createdDate < next_time).count()
-                likes = session.query(Visit).filter(
-                    Visit.createdDate >= cur, Visit.createdDate < next_time, Visit.liked == True).count()
-                users = session.query(User).filter(
-                    User.createdDate >= cur, User.createdDate < next_time).count()
-
-                metrics = metrics + [
-                    Metric(
-                        time=cur, description=Metric.HOURLY_NEW_VISITS, amount=visits),
-                    Metric(time=cur, description=Metric.HOURLY_LIKES, amount=likes),
-                    Metric(
-                        time=cur, description=Metric.HOURLY_NEW_USERS, amount=users)
-                ]
-
-                if len(metrics) > 100:
-                    session.add_all(metrics)
-                    session.commit()
-                    metrics = []
-
-                print("Adding metrics for", cur)
-
-                session.add_all(metrics)
-                session.commit()
-
-                cur = next_time
-
-            session.add_all(metrics)
+            MetricsRollup.catch_up(session)
+            # Reservations are read with their expiry, this only keeps the table small.
+            session.query(Reservation).filter(Reservation.expires <= datetime.datetime.now()).delete()
             session.commit()
-
             session.close()
+            Instrumentation.heartbeat("update_metrics")
 
 
 logger = logging.getLogger('StumbleServerLogs')
@@ -118,11 +211,26 @@ logHandler = handlers.TimedRotatingFileHandler(
     'stumblingon.log', when='midnight', interval=1)
 logHandler.setLevel(logging.INFO)
 logHandler.suffix = "%Y-%m-%d"
-logHandler.setFormatter(logging.Formatter(
-    """%(asctime)s %(levelname)s: %(message)s"""))
-logger.addHandler(logHandler)
-
-app = FastAPI()
+# JSON lines written in batches by a background thread, see StructuredLog.py
+logWriter = StructuredLog.start(
+    logger, logHandler,
+    max_queue=int(os.environ.get("LOG_QUEUE_SIZE", 10000)),
+    sample={"chose": float(os.environ.get("LOG_CHOSE_SAMPLE", 1.0))})
+
+@asynccontextmanager
+async def lifespan(app):
+    await run_in_threadpool(Base.metadata.create_all, engine, tables=[
+        SiteHealth.__table__, SiteCheck.__table__, MetricSketch.__table__, ArchivedVisit.__table__,
+        DataVersion.__table__, Reservation.__table__, SiteStats.__table__])
+    await run_in_threadpool(helper.start)
+    if write_behind:
+        write_behind.start()
+    yield
+    if write_behind:
+        await write_behind.drain()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -131,14 +239,20 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-
-db_string = os.environ["DB_STRING"]
-engine = create_engine(db_string, echo=False, pool_size=15)
-Session = sessionmaker(bind=engine)
-
-session = Session()
+if QueryProfiler.enabled:
+    app.add_middleware(QueryProfiler.ProfileRequests)
+# Added last so it is outermost and times the whole request, see Instrumentation.py
+app.add_middleware(Instrumentation.RequestMetrics, routes=app.routes)
+Instrumentation.instrument_engine(engine, "sync")
+Instrumentation.instrument_engine(async_engine.sync_engine, "async")
+QueryProfiler.install(engine)
+QueryProfiler.install(async_engine.sync_engine)
+
+# Started by lifespan, so importing this module stays cheap
 helper = Helper(Session)
-helper.all_sites = {site.id: site for site in session.query(Site).all()}
+
+# Buffer visit and like writes and commit them in batches, see WriteBehind.py
+write_behind = WriteBehind(AsyncSession) if os.environ.get("WRITE_BEHIND") else None
 
 
 class GetUserRequest(BaseModel):
@@ -150,10 +264,17 @@ class GetSiteRequest(BaseModel):
     prevId: str = ""
 
 
+class GetSitesRequest(BaseModel):
+    userId: str
+    prevIds: List[str] = []
+    count: int = 5
+
+
 class GetHistoryRequest(BaseModel):
     userId: str
-    start: int
+    start: int = 0
     pageSize: int = 10
+    cursor: Optional[str] = None
 
 
 class SubmitSiteRequest(BaseModel):
@@ -173,6 +294,14 @@ class AddSiteRequest(BaseModel):
     reason: Optional[str]
 
 
+class AddSitesRequest(BaseModel):
+    auth: str
+    urls: List[str]
+    userId: str
+    reason: Optional[str] = None
+    check: bool = True
+
+
 class UpdateSubmissionsRequest(BaseModel):
     auth: str
     url: str = "http://example.com"
@@ -182,6 +311,9 @@ class UpdateSubmissionsRequest(BaseModel):
 
 class GetSubmissionsRequest(BaseModel):
     status: int
+    pageSize: Optional[int] = None
+    cursor: Optional[str] = None
+    stream: bool = False
 
 
 class HistoryStumblesRequest(BaseModel):
@@ -189,16 +321,27 @@ class HistoryStumblesRequest(BaseModel):
     end: str = "2020-12-01T00:00:00"
     increment: int = 60
     liked: bool = False
+    exact: bool = False
 
 
 class GetMetricsRequest(BaseModel):
     start: str = "2020-12-01T00:00:00"
     end: str = "2020-12-01T00:00:00"
     metricType: str = Metric.HOURLY_NEW_USERS
+    maxPoints: int = 1000
+
+
+class GetMetricsBatchRequest(BaseModel):
+    start: str = "2020-12-01T00"
+    end: str = "2020-12-01T00"
+    metricTypes: List[str] = list(MetricsRollup.HOURLY)
+    derived: List[str] = []
+    maxPoints: int = 1000
 
 
 class CountUsersRequest(BaseModel):
     nHoursBack: int = 24
+    exact: bool = False
 
 
 def format_date(d: str):
@@ -216,6 +359,14 @@ def get_site_result(url: str, site_id: str):
     }
 
 
+def get_sites_result(sites, reserved_for: int):
+    return {
+        'sites': [{'url': url, 'siteId': site_id} for url, site_id in sites],
+        'reservedFor': reserved_for,
+        "ok": True
+    }
+
+
 def submit_site_result(message: str):
     return {
         "message": message,
@@ -223,165 +374,395 @@ def submit_site_result(message: str):
     }
 
 
-def get_history_result(history, more):
+def get_history_result(history, more, cursor=None):
     return {
         "size": len(history),
         "more": more,
         "results": history,
+        "cursor": cursor,
         "ok": True
     }
 
 
-def visits_between(start, end, like_required):
-    result = []
-    session = Session()
-    result.append((start, session.query(Visit).filter(
-        Visit.createdDate.between(start, end),
-        (not like_required or Visit.liked)).count()
-    ))
-    session.close()
+def encode_cursor(visit_date, site_id):
+    return base64.urlsafe_b64encode(json.dumps([visit_date.isoformat(), site_id]).encode()).decode()
 
-    return result
+
+def decode_cursor(cursor):
+    try:
+        visit_date, site_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(visit_date), site_id
+    except (ValueError, TypeError):
+        return None
 
 
-def users_between(start, end):
-    result = []
-    session = Session()
-    result.append((start, len(set(s.userId for s in session.query(
-        Visit).filter(Visit.createdDate.between(start, end)).all()))))
-    session.close()
+async def visits_between(db, start, end, increment, like_required):
+    """
+    Visits in each `increment` minute bucket from start to end, counted in one grouped query.
+    """
+    visits = VisitArchive.visits_since(start)
+    bucket = bucket_index(visits.c.createdDate, start, increment, engine.dialect.name)
+    query = select(bucket, func.count()).where(
+        *bucket_range(visits.c.createdDate, start, end, increment)).group_by(bucket)
+    if like_required:
+        query = query.where(visits.c.liked == True)
+
+    return zero_fill(await db.execute(query), start, end, increment)
+
 
+async def users_between(db, start, end, increment):
+    """
+    Unique users with a visit in each `increment` minute bucket from start to end.
+    """
+    visits = VisitArchive.visits_since(start)
+    bucket = bucket_index(visits.c.createdDate, start, increment, engine.dialect.name)
+    query = select(bucket, func.count(distinct(visits.c.userId))).where(
+        *bucket_range(visits.c.createdDate, start, end, increment)).group_by(bucket)
+
+    return zero_fill(await db.execute(query), start, end, increment)
+
+
+async def sketched_users_between(db, start, end, increment):
+    """
+    Estimated unique users per bucket from the hourly sketches.  Buckets must be whole hours.
+    """
+    last = start + datetime.timedelta(minutes=increment * bucket_count(start, end, increment))
+    rows = await db.execute(select(MetricSketch.time, MetricSketch.registers).where(
+        MetricSketch.description == MetricSketch.HOURLY_USERS, MetricSketch.time >= start, MetricSketch.time < last))
+    buckets = {}
+    for hour, registers in rows:
+        buckets.setdefault(int((hour - start).total_seconds()) // (increment * 60), []).append(registers)
+
+    result = []
+    for i, (bucket_start, _) in enumerate(zero_fill([], start, end, increment)):
+        bucket_end = bucket_start + datetime.timedelta(minutes=increment)
+        result.append((bucket_start, HyperLogLog.estimate(
+            buckets.get(i, []), helper.sketches.recent(bucket_start, bucket_end))))
     return result
 
 
-def get_user(user_id):
-    session = Session()
-    user = session.query(User).get(user_id)
-    if not user:
-        user = User(id=user_id)
-        session.add(user)
-        session.commit()
-    return user
+async def load_visited(db, user_id, replace=False):
+    if replace or not helper.visited.has_user(user_id):
+        site_ids = await db.scalars(select(VisitArchive.user_visits(user_id).c.siteId))
+        helper.visited.load(user_id, site_ids, replace=replace)
+        if write_behind:
+            for site_id, _, _ in write_behind.visits(user_id):
+                helper.visited.add(user_id, site_id)
+
+
+async def get_user(db, user_id):
+    """
+    Make sure a User row exists for user_id and return the id.  Ids seen before cost no
+    database work, new ones a single insert-if-absent so concurrent first requests can't race.
+    """
+    if helper.visited.has_user(user_id) or helper.known_user(user_id):
+        return user_id
+
+    await db.execute(upsert(User).values(id=user_id).on_conflict_do_nothing())
+    await db.commit()
+    helper.add_known_user(user_id)
+    return user_id
 
 
 @app.post("/countUniqueUsers")
-def count_unique_users(r: CountUsersRequest):
+async def count_unique_users(r: CountUsersRequest, request: Request, db=Depends(get_db)):
     """
     Count the number of unique users who have a visit in the last n hours.
+    Estimated from the hourly sketches (whole hours) unless exact is set.
     """
 
-    session = Session()
+    key = await cache_key(db, request, r, DataVersion.VISITS if r.exact else DataVersion.METRICS)
+    cached = response_cache.get(key)
+    if cached:
+        return cached.response(request)
 
     now = datetime.datetime.now()
     last_n_hours = now - datetime.timedelta(hours=r.nHoursBack)
 
-    users = session.query(Visit).filter(
-        Visit.createdDate >= last_n_hours
-    ).distinct(Visit.userId).count()
-
-    session.close()
+    if r.exact:
+        visits = VisitArchive.visits_since(last_n_hours, now)
+        users = await db.scalar(select(func.count(distinct(visits.c.userId))).where(
+            visits.c.createdDate >= last_n_hours
+        ))
+    else:
+        start = HyperLogLog.floor_hour(last_n_hours)
+        rows = await db.scalars(select(MetricSketch.registers).where(
+            MetricSketch.description == MetricSketch.HOURLY_USERS, MetricSketch.time >= start))
+        users = HyperLogLog.estimate(rows, helper.sketches.recent(start, now + datetime.timedelta(hours=1)))
 
-    return {"ok": True, "count": users}
+    return response_cache.put(key, {"ok": True, "count": users}, ttl=ANALYTICS_TTL).response(request)
 
 
 @app.get("/metrics", response_class=HTMLResponse)
-def read_root():
-    return HTMLResponse(content=helper.metrics_file, status_code=200)
+def read_root(request: Request):
+    return helper.metrics_page.response(request)
+
+
+@app.get("/ready")
+def ready():
+    """
+    Readiness for load balancers and rolling restarts: 503 until this worker has
+    its site catalog and a warm visited index.
+    """
+    status = {"ready": helper.ready(), "catalog": helper.catalog_ready.is_set(), "visited": helper.warmed.is_set(),
+              "sites": len(helper.catalog.current().live)}
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@app.get("/serverMetrics", response_class=PlainTextResponse)
+async def server_metrics():
+    """
+    Request, database and background worker instrumentation for Prometheus.
+    """
+    return PlainTextResponse(Instrumentation.render(), media_type="text/plain; version=0.0.4")
+
+
+# /getSites hands out at most MAX_PREFETCH sites, held for the user this long
+MAX_PREFETCH = 20
+RESERVATION_SECONDS = 10 * 60
+
+
+async def record_visits(db, user_id, site_ids):
+    """
+    Record visits to sites (which must exist) the index doesn't have for the user yet.
+    """
+    new = [site_id for site_id in site_ids if not helper.visited.visited(user_id, site_id)]
+    if new:
+        helper.sketches.add(user_id)
+    if write_behind:
+        # Whatever the buffer refuses because it is full is written straight through.
+        new = [site_id for site_id in new if not write_behind.visit(user_id, site_id)]
+    if new:
+        now = datetime.datetime.now()
+        await db.execute(upsert(Visit).on_conflict_do_nothing(),
+                         [{"userId": user_id, "siteId": site_id, "createdDate": now} for site_id in new])
+        await db.commit()
+    for site_id in site_ids:
+        helper.visited.add(user_id, site_id)
+
+
+async def reserve_sites(db, user_id, site_ids):
+    """
+    Hold sites handed out to a user for RESERVATION_SECONDS, in every worker.
+    """
+    expires = datetime.datetime.now() + datetime.timedelta(seconds=RESERVATION_SECONDS)
+    statement = upsert(Reservation)
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=[Reservation.userId, Reservation.siteId], set_={"expires": statement.excluded.expires}),
+        [{"userId": user_id, "siteId": site_id, "expires": expires} for site_id in site_ids])
+    await db.commit()
+
+
+async def choose_sites(db, user_id, count):
+    """
+    Up to count distinct sites the user hasn't visited or been handed already.
+    """
+    reserved = set(await db.scalars(select(Reservation.siteId).where(
+        Reservation.userId == user_id, Reservation.expires > datetime.datetime.now())))
+    for attempt in range(2):
+        site_ids = []
+        reloaded = False
+        while len(site_ids) < count:
+            site_id = helper.visited.choose(user_id, helper.weights, exclude=reserved.union(site_ids))
+            if site_id is VisitedIndex.UNLOADED and not reloaded:
+                # Evicted by other users since it was loaded.
+                await load_visited(db, user_id)
+                reloaded = True
+                continue
+            if not site_id or site_id is VisitedIndex.UNLOADED:
+                break
+            site_ids.append(site_id)
+        if attempt or not site_ids:
+            return site_ids
+        visits = VisitArchive.user_visits(user_id)
+        stale = await db.scalars(select(visits.c.siteId).where(visits.c.siteId.in_(site_ids)))
+        if not stale.first():
+            return site_ids
+        # Another worker recorded visits this process hasn't seen, so reread this user.
+        await load_visited(db, user_id, replace=True)
 
 
 @app.post("/getSite")
-async def get_site(r: GetSiteRequest):
-    session = Session()
-    user = get_user(r.userId)
+async def get_site(r: GetSiteRequest, db=Depends(get_db)):
+    user_id = await get_user(db, r.userId)
     prev_site = None
 
     if r.prevId:
-        prev_site = session.query(Site).get(r.prevId)
+        prev_site = await db.get(Site, r.prevId)
+
+    await load_visited(db, user_id)
+
+    if prev_site:
+        await record_visits(db, user_id, [prev_site.id])
+
+    site_ids = await choose_sites(db, user_id, 1)
+    if not site_ids:
+        return {"message": "We have no further sites you haven't visited.  Please come back later.  We may get more.", "ok": False}
+
+    site_id = site_ids[0]
+    url = helper.catalog.current().url(site_id)
+    logger.info(f"{r.userId} chose {url}", extra={"event": "chose", "userId": r.userId, "siteId": site_id})
+    return get_site_result(url, site_id)
 
-    if prev_site and (not session.query(Visit).get((prev_site.id, user.id))):
-        session.add(Visit(userId=user.id, siteId=prev_site.id))
-        session.commit()
 
-    visited = set(h.siteId for h in session.query(
-        Visit).filter_by(userId=user.id).all())
-    choose_from = tuple(helper.all_sites.keys() - visited)
+@app.post("/getSites")
+async def get_sites(r: GetSitesRequest, db=Depends(get_db)):
+    """
+    Prefetch for clients: record the sites in prevIds as visited and hand out the
+    next count unvisited sites.  They are reserved for the user in the database, so no
+    worker offers them again until visited or RESERVATION_SECONDS pass.
+    """
+    user_id = await get_user(db, r.userId)
+    prev_ids = list(dict.fromkeys(r.prevIds[:MAX_PREFETCH * 2]))
+    if prev_ids:
+        prev_ids = list(await db.scalars(select(Site.id).where(Site.id.in_(prev_ids))))
+
+    await load_visited(db, user_id)
 
-    if len(choose_from) < 1:
+    if prev_ids:
+        await record_visits(db, user_id, prev_ids)
+
+    site_ids = await choose_sites(db, user_id, max(1, min(r.count, MAX_PREFETCH)))
+    if not site_ids:
         return {"message": "We have no further sites you haven't visited.  Please come back later.  We may get more.", "ok": False}
 
-    result = helper.all_sites[random.choice(choose_from)]
-    session.close()
-    logger.info(f"{r.userId} chose {result.url}")
-    return get_site_result(result.url, result.id)
+    await reserve_sites(db, user_id, site_ids)
+    snapshot = helper.catalog.current()
+    sites = [(snapshot.url(site_id), site_id) for site_id in site_ids]
+    for url, site_id in sites:
+        logger.info(f"{r.userId} chose {url}", extra={"event": "chose", "userId": r.userId, "siteId": site_id})
+    return get_sites_result(sites, RESERVATION_SECONDS)
 
 
 @app.post("/submitSite")
-async def submit_site(r: SubmitSiteRequest):
-    user = get_user(r.userId)
-    session = Session()
-    prev_sub = session.query(Submission).get(r.url)
+async def submit_site(r: SubmitSiteRequest, db=Depends(get_db)):
+    user_id = await get_user(db, r.userId)
+    prev_sub = await db.get(Submission, r.url)
     if prev_sub:
         return submit_site_result(f"{r.url} has already been submitted and status is {prev_sub.get_status()}")
     else:
-        session.add(Submission(url=r.url, userId=user.id))
+        db.add(Submission(url=r.url, userId=user_id, createdDate=datetime.datetime.now()))
 
-    session.commit()
-    session.close()
-    logger.info(f"{r.userId} submitted {r.url}")
+    await db.commit()
+    logger.info(f"{r.userId} submitted {r.url}", extra={"event": "submitted", "userId": r.userId})
     return submit_site_result("Thanks for your submission.  It will be reviewed, and, if approved, added to our index.")
 
 
+def history_entry(site_id, url, liked, visit_date):
+    if url is None:
+        return {"id": "error", "url": "this site has been removed from the index", "liked": liked}
+    return {"id": site_id, "url": url, "liked": liked, "visitDate": visit_date}
+
+
 @app.post("/getHistory")
-async def get_history(r: GetHistoryRequest):
-    user = get_user(r.userId)
-    visits = None
-    session = Session()
-    visits = session.query(Visit).filter_by(userId=user.id).order_by(
-        Visit.createdDate.desc()).offset(r.start).limit(r.pageSize+1).all()
-    visits = [{"id": v.siteId, "url": v.site.url, "liked": v.liked, "visitDate": v.createdDate} if v.site != None else {
-        "id": "error", "url": "this site has been removed from the index", "liked": v.liked} for v in visits]
-    session.close()
+async def get_history(r: GetHistoryRequest, db=Depends(get_db)):
+    """
+    Page through a user's visits, newest first.  Pass the returned cursor to get the next
+    page at constant cost, start still works as an offset for older clients.
+    """
+    user_id = await get_user(db, r.userId)
+    after = None
+    if r.cursor:
+        after = decode_cursor(r.cursor)
+        if not after:
+            return {"ok": False, "message": "Invalid cursor"}
+
+    # Buffered visits are newer than anything committed, so they come first.
+    buffered = write_behind.visits(user_id) if write_behind else []
+    if after:
+        buffered = [v for v in buffered if (v[1], v[0]) < after]
+        offset = 0
+    else:
+        offset = max(0, r.start - len(buffered))
+        buffered = buffered[r.start:]
+    catalog = helper.catalog.current()
+    rows = [(site_id, catalog.url(site_id), liked, visit_date)
+            for site_id, visit_date, liked in buffered[:r.pageSize+1]]
+
+    if len(rows) < r.pageSize + 1:
+        visits = VisitArchive.user_visits(user_id)
+        query = select(visits.c.siteId, Site.url, visits.c.liked, visits.c.createdDate).outerjoin(
+            Site, Site.id == visits.c.siteId)
+        if after:
+            query = query.where(tuple_(visits.c.createdDate, visits.c.siteId) < after)
+        query = query.order_by(visits.c.createdDate.desc(), visits.c.siteId.desc()).offset(
+            offset).limit(r.pageSize+1-len(rows))
+
+        for site_id, url, liked, visit_date in await db.execute(query):
+            entry = write_behind.entry(user_id, site_id) if write_behind else None
+            if entry and entry["insert"]:
+                continue
+            if entry and entry["liked"] is not None:
+                liked = entry["liked"]
+            rows.append((site_id, url, liked, visit_date))
 
     logger.info(
-        f"{r.userId} requested history - start {r.start}, pageSize: {r.pageSize}")
+        f"{r.userId} requested history - start {r.start}, cursor {r.cursor}, pageSize: {r.pageSize}",
+        extra={"event": "history", "userId": r.userId})
     # We get 1 more than the page size and cut it off.  This tells us if more results exist.
-    return get_history_result(visits[:r.pageSize], len(visits) > r.pageSize)
+    page, more = rows[:r.pageSize], len(rows) > r.pageSize
+    cursor = encode_cursor(page[-1][3], page[-1][0]) if more and page else None
+    return get_history_result([history_entry(*row) for row in page], more, cursor)
 
 
 @app.post("/like")
-async def like(r: LikeRequest):
-    user = get_user(r.userId)
-    session = Session()
-    visit = session.query(Visit).get((r.siteId, user.id))
-
-    if not visit:
-        logger.warning(
-            f"{r.userId} tried to like {r.siteId} but has not visited that site.")
-        return {"error": True, "message": f"User {r.userId} has not visited {r.siteId}", "ok": False}
-
-    url = visit.site.url
-    final_like_state = not visit.liked
-    visit.liked = final_like_state
-    session.commit()
-    session.close()
-    logger.info(f"{r.userId} liked {url}")
+async def like(r: LikeRequest, db=Depends(get_db)):
+    user_id = await get_user(db, r.userId)
+    entry = write_behind.entry(user_id, r.siteId) if write_behind else None
+    visit = None
+
+    if not entry:
+        visit = await db.get(Visit, (r.siteId, user_id), options=[joinedload(Visit.site)])
+        if not visit:
+            visit = await db.get(ArchivedVisit, (r.siteId, user_id))
+        if not visit:
+            logger.warning(
+                f"{r.userId} tried to like {r.siteId} but has not visited that site.",
+                extra={"event": "like_unvisited", "userId": r.userId, "siteId": r.siteId})
+            return {"error": True, "message": f"User {r.userId} has not visited {r.siteId}", "ok": False}
+
+    # Likes on archived visits are rare enough to write straight through, as are
+    # the ones the buffer refuses while it is full.  Those always have visit loaded.
+    buffered = False
+    if write_behind and not isinstance(visit, ArchivedVisit):
+        final_like_state = not (entry["liked"] if entry else visit.liked)
+        buffered = write_behind.like(user_id, r.siteId, final_like_state)
+    if buffered:
+        url = visit.site.url if visit else helper.catalog.current().url(r.siteId) or r.siteId
+    else:
+        url = visit.site.url if isinstance(visit, Visit) else helper.catalog.current().url(r.siteId) or r.siteId
+        final_like_state = not visit.liked
+        visit.liked = final_like_state
+        await db.commit()
+    logger.info(f"{r.userId} liked {url}", extra={"event": "liked", "userId": r.userId, "siteId": r.siteId})
     return {"liked": final_like_state, 'ok': True}
 
 
+def check_auth(r, action):
+    """
+    None if the request carries the admin secret, otherwise log the attempt
+    and return the error response for it.
+    """
+    if r.auth == helper.secret:
+        return None
+    user_id = getattr(r, "userId", None)
+    logger.warning(f"{user_id or 'Someone'} tried to {action} but failed auth with key {r.auth}.",
+                   extra={"event": "auth_failed", "userId": user_id})
+    return {
+        'errorMessage': "Invalid auth key",
+        'friendlyMessage': "I do not recognize your secret password.",
+        'isRetryable': False,
+        'ok': False
+    }
+
+
 @app.post("/updateSubmissions")
-async def update_submissions(r: UpdateSubmissionsRequest):
-    if r.auth != helper.secret:
-        logger.warning(
-            f"{r.userId} tried to update submissions but failed auth with key {r.auth}.")
-        return {
-            'errorMessage': "Invalid auth key",
-            'friendlyMessage': "I do not recognize your secret password.",
-            'isRetryable': False,
-            'ok': False
-        }
-
-    session = Session()
-    submission = session.query(Submission).get(r.url)
+async def update_submissions(r: UpdateSubmissionsRequest, db=Depends(get_db)):
+    failed = check_auth(r, f"update submissions for {r.url}")
+    if failed:
+        return failed
+
+    submission = await db.get(Submission, r.url)
     if not submission:
         return {"ok": False, "message": f"There was not submission for {r.url}"}
 
@@ -389,155 +770,430 @@ async def update_submissions(r: UpdateSubmissionsRequest):
     submission.reason = r.reason
     result = {"ok": True, "submissionId": submission.url}
 
-    session.commit()
-    session.close()
+    await db.commit()
 
-    logger.info(f"Updated submission {r.url} to status {r.newStatus}")
+    logger.info(f"Updated submission {r.url} to status {r.newStatus}", extra={"event": "updated_submission"})
     return result
 
 
-@app.post("/getSubmissions")
-async def get_submissions(r: GetSubmissionsRequest):
-    results = None
-    session = Session()
-    results = [s.j()
-               for s in (session.query(Submission).filter_by(status=r.status))]
-    session.close()
+def metric_resolution(metric_types, start, end, max_points):
+    """
+    The finest rollup tier with at most max_points points between start and end.
+    Metrics without tiers are always hourly.
+    """
+    if any(metric_type not in MetricsRollup.HOURLY for metric_type in metric_types):
+        return "hourly"
+    for tier, minutes in MetricsRollup.TIERS.items():
+        if bucket_count(start, end, minutes) <= max_points:
+            return tier
+    return "weekly"
+
+
+async def open_periods(db, rows, metric_types, resolution, start, end):
+    """
+    The rollup only writes a daily or weekly row once the period is over, so sum the
+    hourly rows for the periods in [start, end] after the last tier row each metric
+    has in rows.  Returns (description, time, amount) rows like the tier's own.
+    """
+    minutes = MetricsRollup.TIERS[resolution]
+    step = datetime.timedelta(minutes=minutes)
+    names = {MetricsRollup.tier_description(metric_type, resolution): metric_type for metric_type in metric_types}
+    since = dict.fromkeys(metric_types, start)
+    for description, at, _ in rows:
+        since[names[description]] = max(since[names[description]], at + step)
+    first = min(since.values())
+    if first > end:
+        return []
+
+    period = bucket_index(Metric.time, first, minutes, engine.dialect.name)
+    hours = await db.execute(select(Metric.description, period, func.sum(Metric.amount)).where(
+        Metric.description.in_(metric_types),
+        *bucket_range(Metric.time, first, end + datetime.timedelta(seconds=1), minutes)
+    ).group_by(Metric.description, period))
+    return [(MetricsRollup.tier_description(description, resolution), first + step * int(i), amount or 0)
+            for description, i, amount in hours if first + step * int(i) >= since[description]]
+
+
+def json_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+ANALYTICS_TTL = 60
+# Closed results are kept on the server until the data under them is rewritten, see
+# data_versions, and clients may hold them this long.
+CLOSED_MAX_AGE = 24 * 60 * 60
+# Serialized analytics responses, see ResponseCache.py
+response_cache = ResponseCache.ResponseCache(default=json_default, max_age=CLOSED_MAX_AGE)
+GENERATION_TTL = 10
+generation = {"versions": {}, "rolled_up": {}, "expires": 0.0}
+# Visits can land in a bucket a little after it ends, the write-behind buffer and
+# sketches are flushed within a minute.
+LATE_WRITES = datetime.timedelta(minutes=5)
+
+
+async def data_versions(db):
+    """
+    DataVersion of each source and the end of what each metric tier has rolled up, read
+    at most every GENERATION_TTL seconds.  Each tier's end is a few index lookups.
+    """
+    now = time.monotonic()
+    if now >= generation["expires"]:
+        versions = dict((await db.execute(select(DataVersion.name, DataVersion.version))).all())
+        last = iter((await db.execute(select(*(
+            select(func.max(Metric.time)).where(
+                Metric.description == MetricsRollup.tier_description(description, tier)).scalar_subquery()
+            for tier in MetricsRollup.TIERS for description in MetricsRollup.HOURLY)))).one())
+        rolled_up = {}
+        for tier, minutes in MetricsRollup.TIERS.items():
+            # A tier is rolled up as far as its least advanced metric.
+            times = [next(last) for _ in MetricsRollup.HOURLY]
+            rolled_up[tier] = None if None in times else min(times) + datetime.timedelta(minutes=minutes)
+        generation.update(versions=versions, rolled_up=rolled_up, expires=now + GENERATION_TTL)
+    return generation
+
+
+async def cache_key(db, request, r, *sources):
+    """
+    Keys carry the versions of the data they are computed from, so rewriting one source
+    only drops the results that read it.  GET and POST requests share entries.
+    """
+    versions = (await data_versions(db))["versions"]
+    return (request.url.path, r.model_dump_json(), tuple(versions.get(source, 0) for source in sources))
+
 
-    logger.info(f"Requested submissions with status {r.status}")
-    return {"submissions": results, "size": len(results)}
+def analytics_ttl(closes):
+    """
+    Visit results over buckets that all ended before `closes` are kept until evicted or
+    DataVersion.VISITS changes once late writes are done, anything else for ANALYTICS_TTL seconds.
+    """
+    return None if closes + LATE_WRITES <= datetime.datetime.now() else ANALYTICS_TTL
+
+
+def metrics_ttl(closes, resolution):
+    """
+    Like analytics_ttl for results read from the Metric rows of `resolution` and the
+    sketches, which are final once the rollup has passed `closes` in that tier and hourly.
+    """
+    rolled_up = generation["rolled_up"]
+    ends = [rolled_up.get(resolution), rolled_up.get("hourly")]
+    return None if all(end and end >= closes for end in ends) else ANALYTICS_TTL
+
+
+async def stream_submissions(query):
+    # The request's session is closed before a streamed body is sent, so this uses its own.
+    async with AsyncSession() as session:
+        async for submission in await session.stream_scalars(query.execution_options(yield_per=500)):
+            yield json.dumps(submission.j(), default=json_default) + "\n"
+
+
+@app.post("/getSubmissions")
+async def get_submissions(r: GetSubmissionsRequest, db=Depends(get_db)):
+    """
+    Submissions with a status, oldest first.  With pageSize set results come in pages that
+    continue from the returned cursor, with stream set they are sent as NDJSON.
+    """
+    query = select(Submission).where(Submission.status == r.status).order_by(
+        Submission.createdDate, Submission.url)
+    if r.cursor:
+        after = decode_cursor(r.cursor)
+        if not after:
+            return {"ok": False, "message": "Invalid cursor"}
+        # Compare with the stored row rather than the date in the cursor: sqlite keeps dates from
+        # CURRENT_TIMESTAMP as text without microseconds, which sorts before the same bound datetime.
+        last = aliased(Submission)
+        query = query.join(last, last.url == after[1]).where(
+            tuple_(Submission.createdDate, Submission.url) > tuple_(last.createdDate, last.url))
+
+    logger.info(f"Requested submissions with status {r.status}", extra={"event": "submissions"})
+    if r.stream:
+        return StreamingResponse(stream_submissions(query), media_type="application/x-ndjson")
+
+    if r.pageSize:
+        query = query.limit(r.pageSize + 1)
+    submissions = list(await db.scalars(query))
+    more = bool(r.pageSize) and len(submissions) > r.pageSize
+    if more:
+        submissions = submissions[:r.pageSize]
+    results = [s.j() for s in submissions]
+    cursor = encode_cursor(submissions[-1].createdDate, submissions[-1].url) if more else None
+
+    return {"submissions": results, "size": len(results), "more": more, "cursor": cursor}
 
 
 @app.post("/addSite")
-async def like(r: AddSiteRequest):
-    if r.auth != helper.secret:
-        logger.warning(
-            f"{r.userId} tried to add site but failed auth with key {r.auth}."
-        )
-        return {
-            'errorMessage': "Invalid auth key",
-            'friendlyMessage': "I do not recognize your secret password.",
-            'isRetryable': False,
-            'ok': False
-        }
+async def add_site(r: AddSiteRequest, db=Depends(get_db)):
+    failed = check_auth(r, "add site")
+    if failed:
+        return failed
 
     new_site = None
-    session = Session()
-    submission = session.query(Submission).get(r.url)
+    submission = await db.get(Submission, r.url)
     if not submission:
         submission = Submission(
-            userId=get_user(r.userId).id,
+            userId=await get_user(db, r.userId),
             status=1,
             reason="Submitted by owner.",
-            url=r.url
+            url=r.url,
+            createdDate=datetime.datetime.now()
         )
-        session.add(submission)
+        db.add(submission)
     else:
         submission.status = 1
         submission.reason = r.reason if r.reason else ""
 
     new_site = Site(id=str(uuid4()), url=submission.url)
-    session.add(new_site)
+    db.add(new_site)
     result = {"ok": True, "siteId": new_site.id}
-    session.commit()
-    session.close()
-    logger.info(f"{r.userId} added {r.url}")
+    await db.commit()
+    # Serve it right away in every worker instead of waiting for its first health check.
+    await run_in_threadpool(helper.catalog.publish, added=[(new_site.id, new_site.url)])
+    logger.info(f"{r.userId} added {r.url}", extra={"event": "added", "userId": r.userId, "siteId": new_site.id})
     return result
 
 
+# Urls per /addSites request, larger lists go through SiteIngest.py from the command line
+MAX_BULK_SITES = 5000
+
+
+@app.post("/addSites")
+async def add_sites(r: AddSitesRequest, db=Depends(get_db)):
+    """
+    Add many sites at once, see SiteIngest.py.  With check the urls are requested
+    first and only the ones that respond are added.
+    """
+    failed = check_auth(r, "add sites")
+    if failed:
+        return failed
+    if len(r.urls) > MAX_BULK_SITES:
+        return {"ok": False, "message": f"At most {MAX_BULK_SITES} urls per request"}
+
+    checker = HealthChecker(timeout=SiteIngest.CHECK_TIMEOUT) if r.check else None
+    result = await SiteIngest.ingest(
+        db, r.urls, await get_user(db, r.userId), r.reason or SiteIngest.DEFAULT_REASON, checker)
+    if result["added"]:
+        await run_in_threadpool(helper.catalog.publish, added=result["added"])
+    logger.info(f"{r.userId} added {len(result['added'])} of {len(r.urls)} sites",
+                extra={"event": "added_bulk", "userId": r.userId})
+    return {
+        "added": [{"siteId": site_id, "url": url} for site_id, url in result["added"]],
+        "duplicates": result["duplicates"],
+        "invalid": result["invalid"],
+        "unreachable": [{"url": url, "statusCode": status, "error": error}
+                        for url, status, error in result["unreachable"]],
+        "ok": True
+    }
+
+
 @app.post("/getMetrics")
-async def get_metrics(r: GetMetricsRequest):
+async def get_metrics(r: GetMetricsRequest, request: Request, db=Depends(get_db)):
     """
-    Return a series of (datetime, amount) pairs representing the requested metric
+    Return a series of (datetime, amount) pairs representing the requested metric.
+    Long ranges are served from the daily or weekly rollups, whichever is the
+    finest that needs no more than maxPoints points.  The current day or week has
+    no rollup row yet and is summed from the hourly metrics instead.
     """
 
+    key = await cache_key(db, request, r, DataVersion.METRICS)
+    cached = response_cache.get(key)
+    if cached:
+        return cached.response(request)
+
     try:
         start_date = datetime.datetime.strptime(r.start, "%Y-%m-%dT%H")
         end_date = datetime.datetime.strptime(r.end, "%Y-%m-%dT%H")
     except ValueError:
         return {"ok": False, "message": "Invalid date format.  Use YYYY-MM-DD:HH"}
 
-    # If end_date is more than 10 days after start_date return an error
-    if (end_date - start_date).days > 10:
-        return {"ok": False, "message": "The date range must be less than 10 days"}
-
     # If end_date comes before start_date return an error
     if end_date <= start_date:
         return {"ok": False, "message": "The end date must be after the start date"}
 
+    if r.maxPoints < 1:
+        return {"ok": False, "message": "maxPoints must be at least 1"}
+
+    resolution = metric_resolution([r.metricType], start_date, end_date, r.maxPoints)
+    if resolution != "hourly":
+        # A period that started before start_date is still part of the range.
+        start_date = MetricsRollup.floor_period(start_date, resolution)
+
     # Get all metrics of requested type between start and end times
-    session = Session()
-    metrics = session.query(Metric).filter(
-        Metric.description == r.metricType,
+    metrics = await db.execute(select(Metric.time, Metric.amount).where(
+        Metric.description == MetricsRollup.tier_description(r.metricType, resolution),
         Metric.time >= start_date,
         Metric.time <= end_date
-    ).all()
+    ).order_by(Metric.time))
 
-    result = [(m.time, m.amount) for m in metrics]
-    session.close()
+    result = [(at, amount) for at, amount in metrics]
+    if resolution != "hourly":
+        description = MetricsRollup.tier_description(r.metricType, resolution)
+        result += sorted((at, amount) for _, at, amount in await open_periods(
+            db, [(description, at, amount) for at, amount in result], [r.metricType], resolution, start_date, end_date))
 
     logger.info(
-        f"Requested metrics {r.metricType} between {r.start} and {r.end}")
-    return {"metrics": result, "ok": True}
+        f"Requested metrics {r.metricType} between {r.start} and {r.end}", extra={"event": "metrics"})
+    closes = MetricsRollup.floor_period(end_date, resolution) + \
+        datetime.timedelta(minutes=MetricsRollup.TIERS[resolution])
+    return response_cache.put(key, {"metrics": result, "resolution": resolution, "ok": True},
+                              ttl=metrics_ttl(closes, resolution)).response(request)
+
+
+DERIVED_METRICS = {
+    # name -> metrics it is computed from
+    "likeRate": (Metric.HOURLY_LIKES, Metric.HOURLY_NEW_VISITS),
+    "uniqueUsers": (),
+}
+
+
+@app.post("/getMetricsBatch")
+async def get_metrics_batch(r: GetMetricsBatchRequest, request: Request, db=Depends(get_db)):
+    """
+    Several metrics over one range, read with a single query and aligned on one
+    time axis with 0 for missing points, plus each series' total.  Derived series
+    are likeRate (likes per visit at each point) and uniqueUsers, an estimated
+    total from the hourly sketches.
+    """
+
+    key = await cache_key(db, request, r, DataVersion.METRICS)
+    cached = response_cache.get(key)
+    if cached:
+        return cached.response(request)
+
+    try:
+        start_date = datetime.datetime.strptime(r.start, "%Y-%m-%dT%H")
+        end_date = datetime.datetime.strptime(r.end, "%Y-%m-%dT%H")
+    except ValueError:
+        return {"ok": False, "message": "Invalid date format.  Use YYYY-MM-DD:HH"}
+
+    if end_date <= start_date:
+        return {"ok": False, "message": "The end date must be after the start date"}
+
+    if r.maxPoints < 1:
+        return {"ok": False, "message": "maxPoints must be at least 1"}
+
+    unknown = [name for name in r.derived if name not in DERIVED_METRICS]
+    if unknown:
+        return {"ok": False, "message": f"Unknown derived metrics: {', '.join(unknown)}"}
+
+    metric_types = list(dict.fromkeys(
+        r.metricTypes + [metric_type for name in r.derived for metric_type in DERIVED_METRICS[name]]))
+    resolution = metric_resolution(metric_types, start_date, end_date, r.maxPoints)
+    minutes = MetricsRollup.TIERS[resolution]
+    start_date = MetricsRollup.floor_period(start_date, resolution)
+    names = {MetricsRollup.tier_description(metric_type, resolution): metric_type for metric_type in metric_types}
+
+    rows = await db.execute(select(Metric.description, Metric.time, Metric.amount).where(
+        Metric.description.in_(names),
+        Metric.time >= start_date,
+        Metric.time <= end_date
+    ))
+    rows = list(rows)
+    if resolution != "hourly":
+        rows += await open_periods(db, rows, metric_types, resolution, start_date, end_date)
+
+    # Points on the axis are the periods starting in [start, end].
+    n_points = bucket_count(start_date, end_date + datetime.timedelta(seconds=1), minutes)
+    times = [start_date + datetime.timedelta(minutes=minutes * i) for i in range(n_points)]
+    series = {metric_type: [0] * n_points for metric_type in metric_types}
+    for description, at, amount in rows:
+        i = int((at - start_date).total_seconds()) // (minutes * 60)
+        if i < n_points:
+            series[names[description]][i] += amount or 0
+
+    totals = {metric_type: sum(values) for metric_type, values in series.items()}
+    if "likeRate" in r.derived:
+        series["likeRate"] = [likes / visits if visits else 0 for likes, visits in zip(
+            series[Metric.HOURLY_LIKES], series[Metric.HOURLY_NEW_VISITS])]
+        visits = totals[Metric.HOURLY_NEW_VISITS]
+        totals["likeRate"] = totals[Metric.HOURLY_LIKES] / visits if visits else 0
+    if "uniqueUsers" in r.derived:
+        sketch_start = HyperLogLog.floor_hour(start_date)
+        sketch_end = end_date + datetime.timedelta(hours=1)
+        registers = await db.scalars(select(MetricSketch.registers).where(
+            MetricSketch.description == MetricSketch.HOURLY_USERS,
+            MetricSketch.time >= sketch_start, MetricSketch.time < sketch_end))
+        totals["uniqueUsers"] = HyperLogLog.estimate(registers, helper.sketches.recent(sketch_start, sketch_end))
+
+    logger.info(f"Requested metrics {', '.join(metric_types)} between {r.start} and {r.end}",
+                extra={"event": "metrics"})
+    result = {"ok": True, "resolution": resolution, "times": times,
+              "series": {name: values for name, values in series.items() if name in r.metricTypes or name in r.derived},
+              "totals": {name: value for name, value in totals.items() if name in r.metricTypes or name in r.derived}}
+    closes = times[-1] + datetime.timedelta(minutes=minutes) if times else end_date
+    return response_cache.put(key, result, ttl=metrics_ttl(closes, resolution)).response(request)
 
 
 @app.post("/historyStumbles")
-async def history_stumbles(r: HistoryStumblesRequest):
+async def history_stumbles(r: HistoryStumblesRequest, request: Request, db=Depends(get_db)):
     """
     Intended to return number of stumbles over time
     """
 
-    key = (r.start, r.increment, r.liked)
-    if key in helper.memo and datetime.datetime.utcnow() - helper.memo[key]["time"] < datetime.timedelta(minutes=10):
-        return helper.memo[key]["result"]
+    key = await cache_key(db, request, r, DataVersion.VISITS)
+    cached = response_cache.get(key)
+    if cached:
+        return cached.response(request)
 
     start = format_date(r.start)
     end = format_date(r.end)
-    increment = datetime.timedelta(minutes=r.increment)
 
     if not start or not end:
         return {"message": "start and end need format: 'YYYY-MM-DDTHH:MM:SS'"}
 
-    result = []
-    while start < end:
-        result.extend(visits_between(
-            start, start+increment, like_required=r.liked))
-        start = start + increment
+    if r.increment < 1:
+        return {"message": "increment must be at least 1 minute"}
 
-    helper.memo[key] = {"time": datetime.datetime.utcnow(), "result": result}
-    if len(helper.memo) > 1000:
-        helper.memo = {}
+    result = await visits_between(db, start, end, r.increment, like_required=r.liked)
 
-    logger.info(f"Requested history of stumbles between {r.start} and {r.end}")
-    return result
+    logger.info(f"Requested history of stumbles between {r.start} and {r.end}", extra={"event": "history_stumbles"})
+    closes = start + datetime.timedelta(minutes=r.increment * bucket_count(start, end, r.increment))
+    return response_cache.put(key, result, ttl=analytics_ttl(closes)).response(request)
 
 
 @app.post("/historyUsers")
-async def history_users(r: HistoryStumblesRequest):
+async def history_users(r: HistoryStumblesRequest, request: Request, db=Depends(get_db)):
     """
     Intended to return number of unique users over time
     """
-    # This caches the last call, so it will kind of break getting a unique response per parameter.
 
-    key = (r.start, r.increment)
-    if key in helper.memo and datetime.datetime.utcnow() - helper.memo[key]["time"] < datetime.timedelta(minutes=10):
-        return helper.memo[key]["result"]
+    key = await cache_key(db, request, r, DataVersion.VISITS, DataVersion.METRICS)
+    cached = response_cache.get(key)
+    if cached:
+        return cached.response(request)
 
     start = format_date(r.start)
     end = format_date(r.end)
-    increment = datetime.timedelta(minutes=r.increment)
 
     if not start or not end:
         return {"message": "start and end need format: 'YYYY-MM-DDTHH:MM:SS'"}
 
-    result = []
-    while start < end:
-        result.extend(users_between(start, start+increment))
-        start = start + increment
+    if r.increment < 1:
+        return {"message": "increment must be at least 1 minute"}
 
-    helper.memo[key] = {"time": datetime.datetime.utcnow(), "result": result}
-    if len(helper.memo) > 1000:
-        helper.memo = {}
+    if r.exact or r.increment % 60 or start.minute or start.second:
+        result = await users_between(db, start, end, r.increment)
+    else:
+        result = await sketched_users_between(db, start, end, r.increment)
 
-    logger.info(f"Requested history of users between {r.start} and {r.end}")
-    return result
+    logger.info(f"Requested history of users between {r.start} and {r.end}", extra={"event": "history_users"})
+    closes = start + datetime.timedelta(minutes=r.increment * bucket_count(start, end, r.increment))
+    return response_cache.put(key, result, ttl=analytics_ttl(closes)).response(request)
+
+
+def query_route(handler, model):
+    async def route(r: Annotated[model, Query()], request: Request, db=Depends(get_db)):
+        return await handler(r, request, db)
+    route.__name__ = f"{handler.__name__}_get"
+    return route
+
+
+# The analytics also answer GET with the request's fields as query parameters, so browsers
+# and shared caches keep the responses and revalidate them with If-None-Match.
+for path, handler, model in [
+        ("/countUniqueUsers", count_unique_users, CountUsersRequest),
+        ("/getMetrics", get_metrics, GetMetricsRequest),
+        ("/getMetricsBatch", get_metrics_batch, GetMetricsBatchRequest),
+        ("/historyStumbles", history_stumbles, HistoryStumblesRequest),
+        ("/historyUsers", history_users, HistoryStumblesRequest)]:
+    app.get(path)(query_route(handler, model))
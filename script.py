@@ -13,6 +13,7 @@ import os
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
 from SqlAlchemyTables import *
+import MetricsRollup
 
 
 app = FastAPI()
@@ -42,48 +43,7 @@ def update_metrics():
     """
 
     session = Session()
-
-    last_metric = session.query(Metric).order_by(Metric.time.desc()).first()
-    print(last_metric.time)
-    cur = datetime.datetime(last_metric.time.year, last_metric.time.month,
-                            last_metric.time.day, last_metric.time.hour)
-    # cur = datetime.datetime(2020, 12, 14, 5)
-    now_time = datetime.datetime.now()
-    metrics = []
-
-    while cur < now_time:
-        next_time = cur + datetime.timedelta(hours=1)
-
-        visits = session.query(Visit).filter(
-            Visit.createdDate >= cur, Visit.createdDate < next_time).count()
-        likes = session.query(Visit).filter(
-            Visit.createdDate >= cur, Visit.createdDate < next_time, Visit.liked == True).count()
-        users = session.query(User).filter(
-            User.createdDate >= cur, User.createdDate < next_time).count()
-
-        metrics = metrics + [
-            Metric(time=cur, description=Metric.HOURLY_NEW_VISITS, amount=visits),
-            Metric(time=cur, description=Metric.HOURLY_LIKES, amount=likes),
-            Metric(time=cur, description=Metric.HOURLY_NEW_USERS, amount=users)
-        ]
-
-        print(len(metrics))
-
-        if len(metrics) > 100:
-            session.add_all(metrics)
-            session.commit()
-            metrics = []
-
-        print("Adding metrics for", cur)
-
-        session.add_all(metrics)
-        session.commit()
-
-        cur = next_time
-
-    session.add_all(metrics)
-    session.commit()
-
+    MetricsRollup.catch_up(session)
     session.close()
 
 
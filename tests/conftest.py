@@ -0,0 +1,41 @@
+"""
+Runs the server against a fresh sqlite database in a temporary directory.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="stumble-tests-")
+
+sys.path.insert(0, ROOT)
+# Read when Database and main are imported.
+os.environ["DB_STRING"] = f"sqlite:///{os.path.join(WORKDIR, 'test.db')}"
+os.environ["SECRET_KEY"] = "test-secret"
+os.environ["SITE_CATALOG"] = os.path.join(WORKDIR, "sitecatalog.bin")
+
+
+@pytest.fixture(scope="session")
+def engine():
+    from Database import engine
+    from SqlAlchemyTables import Base
+
+    Base.metadata.create_all(engine)
+    return engine
+
+
+@pytest.fixture(scope="session")
+def client(engine):
+    from fastapi.testclient import TestClient
+
+    cwd = os.getcwd()
+    os.chdir(WORKDIR)  # main opens its log file in the working directory
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    with TestClient(main.app) as client:
+        yield client
@@ -0,0 +1,32 @@
+import datetime
+
+import pytest
+
+from SqlAlchemyTables import Submission
+
+
+def all_pages(client, status, page_size):
+    urls, cursor = [], None
+    while True:
+        page = client.post("/getSubmissions", json={"status": status, "pageSize": page_size, "cursor": cursor}).json()
+        urls += [submission["url"] for submission in page["submissions"]]
+        if not page["more"]:
+            return urls
+        cursor = page["cursor"]
+
+
+@pytest.mark.parametrize("status, created", [
+    # Left to CURRENT_TIMESTAMP, as bulk imports used to: sqlite stores these without microseconds.
+    (10, None),
+    (11, datetime.datetime(2024, 5, 1, 12, 30)),
+])
+def test_pages_keep_submissions_with_equal_dates(client, engine, status, created):
+    urls = [f"https://same-date.example.com/{status}/{i:02}" for i in range(25)]
+    rows = [{"url": url, "status": status} for url in urls]
+    if created:
+        for row in rows:
+            row["createdDate"] = created
+    with engine.begin() as conn:
+        conn.execute(Submission.__table__.insert(), rows)
+
+    assert all_pages(client, status, 10) == urls